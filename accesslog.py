@@ -0,0 +1,139 @@
+# Structured access log.
+#
+# When ACCESS_LOG is set to a file name, or to - for standard error, each
+# request is logged as a JSON object on one line. The record has the
+# method, path, query, status, response size and duration of the request.
+# Handlers add fields with add() and phase timings with phase().
+#
+# When PROFILE_FRACTION is set, that fraction of requests is run under
+# cProfile and the PROFILE_TOP functions with the most cumulative time are
+# added to the record. One request at a time is profiled. Downloads rendered
+# in a worker process are not included in the profile.
+
+import contextlib
+import cProfile
+import datetime
+import flask
+import json
+import logging
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+from typing import Any
+
+ACCESS_LOG = os.environ.get('ACCESS_LOG', '')
+PROFILE_FRACTION = float(os.environ.get('PROFILE_FRACTION', '0'))
+PROFILE_TOP = int(os.environ.get('PROFILE_TOP', '20'))
+
+_log = logging.getLogger('aztdata.access')
+_profile_lock = threading.Lock()
+
+
+def enabled() -> bool:
+    return bool(ACCESS_LOG)
+
+
+def add(**fields: Any) -> None:
+    # Add fields to the record for the current request.
+    record = flask.g.get('_access')
+    if record is not None:
+        record.update(fields)
+
+
+@contextlib.contextmanager
+def phase(name: str):
+    # Add the time in milliseconds of the with block to the record.
+    t = time.perf_counter()
+    try:
+        yield
+    finally:
+        record = flask.g.get('_access')
+        if record is not None:
+            ms = (time.perf_counter() - t) * 1000
+            record.setdefault('phases', {})[name] = round(ms, 3)
+
+
+def _before_request() -> None:
+    flask.g._access_start = time.perf_counter()
+    flask.g._access = {}
+    if (
+        PROFILE_FRACTION > 0
+        and random.random() < PROFILE_FRACTION
+        and _profile_lock.acquire(blocking=False)
+    ):
+        profile = cProfile.Profile()
+        flask.g._profile = profile
+        profile.enable()
+
+
+def _after_request(resp: flask.Response) -> flask.Response:
+    record = flask.g.get('_access')
+    if record is not None:
+        record['status'] = resp.status_code
+        record['bytes'] = resp.content_length
+    return resp
+
+
+def _top_functions(profile: cProfile.Profile) -> list[dict]:
+    stats = pstats.Stats(profile)
+    rows = sorted(
+        stats.stats.items(),  # type: ignore[attr-defined]
+        key=lambda item: item[1][3],
+        reverse=True,
+    )
+    result = []
+    for (fname, line, func), (_, ncalls, tottime, cumtime, _) in rows[
+        :PROFILE_TOP
+    ]:
+        result.append(
+            dict(
+                function=f'{os.path.basename(fname)}:{line}({func})',
+                calls=ncalls,
+                tottime_ms=round(tottime * 1000, 3),
+                cumtime_ms=round(cumtime * 1000, 3),
+            )
+        )
+    return result
+
+
+def _teardown_request(exception) -> None:
+    profile = flask.g.pop('_profile', None)
+    if profile is not None:
+        profile.disable()
+        _profile_lock.release()
+    record = flask.g.pop('_access', None)
+    if record is None:
+        return
+    request = flask.request
+    entry = dict(
+        time=datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        method=request.method,
+        path=request.path,
+        query=request.query_string.decode('latin-1'),
+        status=500 if exception is not None else record.pop('status', None),
+        ms=round((time.perf_counter() - flask.g._access_start) * 1000, 3),
+    )
+    entry.update(record)
+    if profile is not None:
+        entry['profile'] = _top_functions(profile)
+    _log.info(json.dumps(entry, separators=(',', ':'), default=str))
+
+
+def init_app(app: flask.Flask) -> None:
+    # Log the requests to app if ACCESS_LOG is set.
+    if not enabled():
+        return
+    if ACCESS_LOG == '-':
+        handler: logging.Handler = logging.StreamHandler(sys.stderr)
+    else:
+        handler = logging.FileHandler(ACCESS_LOG)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    _log.addHandler(handler)
+    _log.setLevel(logging.INFO)
+    _log.propagate = False
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
@@ -0,0 +1,164 @@
+# ASGI entry point for the application.
+#
+# Run with any ASGI server, for example:
+#
+#   uvicorn asgi:app
+#
+# Requests are read and responses are sent on the event loop. The Flask
+# application, including rendering and compression of downloads, runs in a
+# bounded thread pool. A slow client holds a coroutine while the response
+# drains instead of a pool thread.
+
+from collections import abc
+import asyncio
+import concurrent.futures
+import io
+import os
+import sys
+import typing
+import main
+
+# Number of threads running the Flask application.
+RENDER_WORKERS = int(os.environ.get('RENDER_WORKERS', os.cpu_count() or 1))
+
+_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=RENDER_WORKERS, thread_name_prefix='render'
+)
+
+
+def _environ(scope, body: bytes) -> dict:
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'],
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f'HTTP/{scope["http_version"]}',
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        key = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if key == 'CONTENT_TYPE' or key == 'CONTENT_LENGTH':
+            environ[key] = value
+            continue
+        key = f'HTTP_{key}'
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+class _Response(typing.NamedTuple):
+    status: str
+    headers: list[tuple[str, str]]
+    # First non-empty chunk of the body, or None if the body is empty.
+    first: bytes | None
+    chunks: abc.Iterator[bytes]
+    # The iterable returned by the application, closed after the body.
+    result: abc.Iterable[bytes]
+
+
+def _call_wsgi(environ) -> _Response:
+    # Run the application. Flask renders the body before returning, so this
+    # is where most of the CPU work happens. Streamed bodies, such as
+    # bundles, are produced as the chunks are read.
+    status_headers = []
+
+    def start_response(status, headers, exc_info=None):
+        _ = exc_info
+        status_headers[:] = [status, headers]
+
+    result = main.app(environ, start_response)
+    try:
+        it = iter(result)
+        # start_response may be called when the first chunk is read.
+        first = _next_chunk(it)
+        status, headers = status_headers
+    except BaseException:
+        _close(result)
+        raise
+    return _Response(status, headers, first, it, result)
+
+
+def _next_chunk(it: abc.Iterator[bytes]) -> bytes | None:
+    # Return the next non-empty chunk, or None at the end of the body.
+    for chunk in it:
+        if chunk:
+            return chunk
+    return None
+
+
+def _close(result) -> None:
+    if hasattr(result, 'close'):
+        result.close()
+
+
+async def _lifespan(receive, send) -> None:
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            _executor.shutdown(wait=False, cancel_futures=True)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send) -> None:
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    body = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+        body.append(message.get('body', b''))
+        if not message.get('more_body', False):
+            break
+
+    loop = asyncio.get_running_loop()
+    resp = await loop.run_in_executor(
+        _executor, _call_wsgi, _environ(scope, b''.join(body))
+    )
+
+    # Send each chunk as it is read so that streamed bodies are not held in
+    # memory.
+    try:
+        await send(
+            {
+                'type': 'http.response.start',
+                'status': int(resp.status.split(' ', 1)[0]),
+                'headers': [
+                    (k.lower().encode('latin-1'), v.encode('latin-1'))
+                    for k, v in resp.headers
+                ],
+            }
+        )
+        chunk = resp.first
+        while chunk is not None:
+            await send(
+                {
+                    'type': 'http.response.body',
+                    'body': chunk,
+                    'more_body': True,
+                }
+            )
+            chunk = await loop.run_in_executor(
+                _executor, _next_chunk, resp.chunks
+            )
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        await loop.run_in_executor(_executor, _close, resp.result)
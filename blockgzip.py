@@ -0,0 +1,119 @@
+# Block parallel gzip compression.
+#
+# The input is split into BLOCK_SIZE blocks that are compressed in a pool of
+# threads. zlib releases the GIL while it compresses, so the blocks are
+# compressed in parallel. As in pigz, each block is compressed as raw
+# deflate primed with the last 32 KiB of the previous block as the
+# dictionary, and all but the last block end with a sync flush, so the
+# concatenated blocks are a single deflate stream in one gzip member. The
+# output depends only on the input, not on how the input is written or on
+# the number of threads.
+#
+# Output smaller than a block is compressed in the calling thread.
+
+from collections import abc
+import collections
+import concurrent.futures
+import io
+import os
+import struct
+import threading
+import zlib
+
+BLOCK_SIZE = int(os.environ.get('GZIP_BLOCK_SIZE', 256 * 1024))
+
+THREADS = int(os.environ.get('GZIP_THREADS', min(4, os.cpu_count() or 1)))
+
+# The level used by gzip.GzipFile.
+LEVEL = 9
+
+# Size of the deflate window.
+_WINDOW = 32 * 1024
+
+# Header with no file name and zero modification time so that equal inputs
+# have equal outputs. XFL 2 is maximum compression and OS 255 is unknown.
+_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x02\xff'
+
+_lock = threading.Lock()
+_pool: concurrent.futures.ThreadPoolExecutor | None = None
+
+
+def _get_pool() -> concurrent.futures.ThreadPoolExecutor:
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = concurrent.futures.ThreadPoolExecutor(
+                THREADS, thread_name_prefix='gzip'
+            )
+        return _pool
+
+
+def _compress(block: bytes, zdict: bytes, last: bool) -> bytes:
+    if zdict:
+        c = zlib.compressobj(LEVEL, zlib.DEFLATED, -15, zdict=zdict)
+    else:
+        c = zlib.compressobj(LEVEL, zlib.DEFLATED, -15)
+    return c.compress(block) + c.flush(
+        zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH
+    )
+
+
+class Writer(io.BufferedIOBase):
+    # Binary file that writes the gzip compressed data to out. Compressed data
+    # is passed to out in order as blocks complete. close() writes the last
+    # block and the trailer. It does not close out.
+
+    def __init__(self, out: abc.Callable[[bytes], object]):
+        self._out = out
+        self._buf = bytearray()
+        self._prev = b''
+        self._crc = 0
+        self._size = 0
+        # Blocks submitted to the pool and not yet written to out.
+        self._pending: collections.deque[concurrent.futures.Future] = (
+            collections.deque()
+        )
+        out(_HEADER)
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        if self.closed:
+            raise ValueError('write to closed file')
+        n = len(data)
+        self._buf += data
+        # Keep the last block in the buffer. It is compressed by close().
+        while len(self._buf) > BLOCK_SIZE:
+            block = bytes(self._buf[:BLOCK_SIZE])
+            del self._buf[:BLOCK_SIZE]
+            self._submit(block)
+        return n
+
+    def _submit(self, block: bytes) -> None:
+        self._crc = zlib.crc32(block, self._crc)
+        self._size += len(block)
+        self._pending.append(
+            _get_pool().submit(_compress, block, self._prev[-_WINDOW:], False)
+        )
+        self._prev = block
+        # Write completed blocks and limit the number in progress.
+        while self._pending and (
+            self._pending[0].done() or len(self._pending) > THREADS
+        ):
+            self._out(self._pending.popleft().result())
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        try:
+            block = bytes(self._buf)
+            self._buf.clear()
+            self._crc = zlib.crc32(block, self._crc)
+            self._size += len(block)
+            while self._pending:
+                self._out(self._pending.popleft().result())
+            self._out(_compress(block, self._prev[-_WINDOW:], True))
+            self._out(struct.pack('<II', self._crc, self._size & 0xFFFFFFFF))
+        finally:
+            super().close()
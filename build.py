@@ -1,14 +1,36 @@
 # Build data files for the application. The data files are:
 #
-#   trail.db - SQLlite database with passages and waypoints tables.
+#   trail.db - SQLlite database with passages, waypoints, waypoint_types
+#       and simplified tables. The waypoint_types table assigns an ID to
+#       each waypoint type for selecting types with a bitmask. IDs are
+#       kept from the previous version. The simplified table has the track
+#       for each passage simplified for each zoom level in tiles.py.
+#       Waypoints are snapped to the trail to find the along trail mile.
+#       The database is never modified after the build. It has covering
+#       indexes for the queries in main.py and is analyzed and vacuumed so
+#       that the server can open it as an immutable file. The
+#       waypoint_search table is an FTS5 full-text index of the waypoints.
 #   *.csv - Track as a CSV file with lon, lat, and ele fields.
+#   tracks.bin - All tracks as packed arrays. See trackstore.py.
+#
+# Each build writes the files to a new directory dst/versions/<version> and
+# then atomically replaces the dst/current symlink with a link to the new
+# directory. The server switches to the new version without a restart.
+# Older versions are removed, except for the KEEP_VERSIONS most recent,
+# so that requests in progress on the previous version can complete.
 
 import shapefile
 import csv
+import geo
+import json
 import pathlib
 import sqlite3
 import sys
 import os
+import shutil
+import tiles
+import time
+import trackstore
 
 # db column name, db column type, record field name
 passage_columns = [
@@ -22,6 +44,13 @@ passage_columns = [
     ('shape_length', 'real', 'Shape_Leng'),
     ('mp_name', 'text', 'MP_Name'),
     ('fname', 'text', None),
+    # Along trail mile at the start of a numbered passage.
+    ('start_mile', 'real', None),
+    # Passage number for numbered passages. NULL for other passages.
+    ('num', 'integer', None),
+    # Offset and number of points of the track in trackstore.FILE.
+    ('track_offset', 'integer', None),
+    ('track_points', 'integer', None),
 ]
 
 waypoint_columns = [
@@ -39,8 +68,18 @@ waypoint_columns = [
     ('lat', 'real', None),
     ('lon', 'real', None),
     ('ele', 'real', None),
+    # Along trail mile of the nearest point on the trail.
+    ('trail_mile', 'real', None),
+    # Distance in miles from the waypoint to the trail.
+    ('off_trail', 'real', None),
+    # ID of the type in the waypoint_types table.
+    ('type_id', 'integer', None),
 ]
 
+# Maximum number of waypoint types. The server selects types with a bitmask
+# in a 64-bit SQLite integer.
+MAX_WAYPOINT_TYPES = 63
+
 
 def create_table_statement(columns, table: str) -> str:
     return f'CREATE TABLE {table} ({", ".join(f"{n} {t}" for n, t, _ in columns)})'
@@ -57,60 +96,243 @@ def column_index(columns, name: str) -> int:
     assert False, f'column {name} not found'
 
 
-TMP_FILE = 'tmp.trail.db'
+def insert_simplified(con, fname: str, points) -> None:
+    points = [(lon, lat) for lon, lat in points]
+    for zoom in range(tiles.MAX_ZOOM, -1, -1):
+        # Each level is simplified from the next higher level.
+        points = tiles.simplify(points, tiles.tolerance(zoom))
+        n = tiles.digits(zoom)
+        coords = [[round(lon, n), round(lat, n)] for lon, lat in points]
+        with con:
+            con.execute(
+                'INSERT INTO simplified values(?, ?, ?)',
+                (fname, zoom, json.dumps(coords, separators=(',', ':'))),
+            )
+
+
 FILE = 'trail.db'
 
+# Page size for the database. Larger pages make the indexes shallower and
+# reads from the memory mapped file more sequential.
+PAGE_SIZE = 16384
+
+# The waypoint columns read by main.py.
+_waypoint_fields = (
+    'type, name, notes, comment, ata_num, lon, lat, ele, trail_mile'
+)
+
+# Indexes created after the tables are loaded.
+_indexes = [
+    # Passages by number, covering the columns for a download.
+    """CREATE INDEX passage_num
+       ON passages (num, passage, name, fname, start_mile)""",
+    # Waypoints of a passage in trail order, covering the waypoint fields.
+    f"""CREATE INDEX waypoint_passage
+        ON waypoints (passage, trail_mile, type_id, {_waypoint_fields})""",
+    # Waypoints in a bounding box for map tiles.
+    'CREATE INDEX waypoint_lon_lat ON waypoints (lon, lat)',
+    'CREATE INDEX simplified_zoom ON simplified (zoom, fname, coords)',
+    # Full-text index of waypoint names, notes and comments for /search.
+    # The other columns are stored for the results. Prefix indexes make
+    # queries for the first characters of a word fast.
+    """CREATE VIRTUAL TABLE waypoint_search USING fts5 (
+        name, notes, comment,
+        type UNINDEXED, ata_num UNINDEXED, lon UNINDEXED, lat UNINDEXED,
+        ele UNINDEXED, trail_mile UNINDEXED, passage UNINDEXED,
+        type_id UNINDEXED,
+        tokenize = 'unicode61 remove_diacritics 2',
+        prefix = '1 2 3'
+    )""",
+    """INSERT INTO waypoint_search
+        (name, notes, comment, type, ata_num, lon, lat, ele, trail_mile,
+         passage, type_id)
+        SELECT name, notes, comment, type, ata_num, lon, lat, ele,
+            trail_mile, passage, type_id
+        FROM waypoints""",
+    """INSERT INTO waypoint_search (waypoint_search) VALUES ('optimize')""",
+]
+
+# Number of versions to keep, including the current version.
+KEEP_VERSIONS = 3
+
+
+def new_version_dir(dst: pathlib.Path) -> pathlib.Path:
+    versions = dst / 'versions'
+    versions.mkdir(parents=True, exist_ok=True)
+    name = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
+    path = versions / name
+    n = 1
+    while path.exists():
+        n += 1
+        path = versions / f'{name}.{n}'
+    path.mkdir()
+    return path
+
+
+def set_current(dst: pathlib.Path, path: pathlib.Path) -> None:
+    # Replace the current link with a link to path.
+    tmp = dst / 'current.tmp'
+    tmp.unlink(missing_ok=True)
+    tmp.symlink_to(path.relative_to(dst), target_is_directory=True)
+    os.replace(tmp, dst / 'current')
+
+
+def prune_versions(dst: pathlib.Path, current: pathlib.Path) -> None:
+    versions = sorted(
+        (p for p in (dst / 'versions').iterdir() if p.is_dir()),
+        key=lambda p: p.stat().st_mtime,
+    )
+    for p in versions[:-KEEP_VERSIONS]:
+        if p != current:
+            shutil.rmtree(p, ignore_errors=True)
+
+
+def previous_type_ids(dst: pathlib.Path) -> dict[str, int]:
+    # Waypoint type IDs in the current version, if any. Before the first
+    # versioned build, the current version is the data in dst itself.
+    db = dst / 'current' / FILE
+    if not db.exists():
+        db = dst / FILE
+    if not db.exists():
+        return {}
+    con = sqlite3.connect(f'file:{db}?mode=ro', uri=True)
+    try:
+        return dict(con.execute('SELECT name, id FROM waypoint_types'))
+    except sqlite3.OperationalError:
+        return {}
+    finally:
+        con.close()
+
+
+def type_ids(types, previous: dict[str, int]) -> dict[str, int]:
+    # Assign IDs to waypoint types. Types keep their ID from the previous
+    # version so that the wp values in saved URLs select the same types.
+    # New types get the lowest unused IDs in name order.
+    ids = {t: previous[t] for t in types if t in previous}
+    free = (i for i in range(MAX_WAYPOINT_TYPES) if i not in ids.values())
+    for t in sorted(set(types) - ids.keys()):
+        i = next(free, None)
+        if i is None:
+            raise ValueError(f'more than {MAX_WAYPOINT_TYPES} waypoint types')
+        ids[t] = i
+    return ids
+
 
 def run(
     dst: pathlib.Path, passage_src: pathlib.Path, waypoints_src: pathlib.Path
 ):
-    dst.mkdir(exist_ok=True)
-    (dst / TMP_FILE).unlink(missing_ok=True)
+    previous = previous_type_ids(dst)
+    path = new_version_dir(dst)
+    build(path, passage_src, waypoints_src, previous)
+    set_current(dst, path)
+    prune_versions(dst, path)
+
 
-    con = sqlite3.connect(dst / TMP_FILE)
+def build(
+    dst: pathlib.Path,
+    passage_src: pathlib.Path,
+    waypoints_src: pathlib.Path,
+    previous_type_ids: dict[str, int],
+):
+    con = sqlite3.connect(dst / FILE)
+    con.execute(f'PRAGMA page_size = {PAGE_SIZE}')
 
     con.execute(create_table_statement(passage_columns, 'passages'))
+    con.execute(
+        'CREATE TABLE simplified (fname text, zoom integer, coords text)'
+    )
 
     stmt = insert_statement(passage_columns, 'passages')
     fname_index = column_index(passage_columns, 'fname')
-    with shapefile.Reader(passage_src) as sf:
+    num_index = column_index(passage_columns, 'num')
+    track_offset_index = column_index(passage_columns, 'track_offset')
+    track_points_index = column_index(passage_columns, 'track_points')
+    track_offset = 0
+    trail = []
+    with (
+        shapefile.Reader(passage_src) as sf,
+        (dst / trackstore.FILE).open('wb') as tracks,
+    ):
         shapes = sf.shapes()
         for i, r in enumerate(sf.records()):
             fname = r['Name'].replace(' ', '').replace("'", '') + '.csv'
             data = [r[c] if c else None for _, _, c in passage_columns]
             data[fname_index] = fname
+            if r['Passage'].isdigit():
+                data[num_index] = int(r['Passage'])
+            data[track_offset_index] = track_offset
+            data[track_points_index] = len(shapes[i].points)
+            track_offset += len(shapes[i].points)
             with con:
                 con.execute(stmt, data)
             with (dst / fname).open('w') as f:
                 w = csv.writer(f, quoting=csv.QUOTE_MINIMAL)
                 for (lon, lat), ele in zip(shapes[i].points, shapes[i].z):
                     w.writerow((lon, lat, ele))
+                    tracks.write(trackstore.point.pack(lon, lat, ele))
+            insert_simplified(con, fname, shapes[i].points)
+            if r['Passage'].isdigit():
+                trail.append((r['Passage'], shapes[i].points))
+
+    # The passages in order from the southern terminus. The tracks are in
+    # the northbound direction.
+    trail.sort(key=lambda t: int(t[0]))
+    trail_track = geo.Track([p for _, points in trail for p in points])
+    start = 0
+    for passage, points in trail:
+        with con:
+            con.execute(
+                'UPDATE passages SET start_mile = ? WHERE passage = ?',
+                (trail_track.miles[start], passage),
+            )
+        start += len(points)
 
     con.execute(create_table_statement(waypoint_columns, 'waypoints'))
-    con.execute('CREATE INDEX waypoint_passage ON waypoints ( passage )')
 
     stmt = insert_statement(waypoint_columns, 'waypoints')
     lon_index = column_index(waypoint_columns, 'lon')
     lat_index = column_index(waypoint_columns, 'lat')
     ele_index = column_index(waypoint_columns, 'ele')
+    trail_mile_index = column_index(waypoint_columns, 'trail_mile')
+    off_trail_index = column_index(waypoint_columns, 'off_trail')
+    type_id_index = column_index(waypoint_columns, 'type_id')
     with shapefile.Reader(waypoints_src) as sf:
         shapes = sf.shapes()
-        for i, r in enumerate(sf.records()):
+        records = sf.records()
+        ids = type_ids([r['Type'] for r in records], previous_type_ids)
+        con.execute(
+            'CREATE TABLE waypoint_types (id integer primary key, name text)'
+        )
+        with con:
+            con.executemany(
+                'INSERT INTO waypoint_types values(?, ?)',
+                ((i, t) for t, i in ids.items()),
+            )
+        for i, r in enumerate(records):
             data = [r[c] if c else None for _, _, c in waypoint_columns]
-            (lon, lat) = shapes[i].points[0]
+            lon, lat = shapes[i].points[0]
             ele = shapes[i].z[0]
             data[lon_index] = lon
             data[lat_index] = lat
             data[ele_index] = ele
+            mile, off_trail = trail_track.nearest(lon, lat)
+            data[trail_mile_index] = mile
+            data[off_trail_index] = off_trail
+            data[type_id_index] = ids[r['Type']]
             with con:
                 con.execute(stmt, data)
 
+    with con:
+        for stmt in _indexes:
+            con.execute(stmt)
+    con.execute('ANALYZE')
+    con.execute('VACUUM')
     con.close()
-    os.replace(dst / TMP_FILE, dst / FILE)
 
 
-run(
-    pathlib.Path(sys.argv[1]),
-    pathlib.Path(sys.argv[2]),
-    pathlib.Path(sys.argv[3]),
-)
+if __name__ == '__main__':
+    run(
+        pathlib.Path(sys.argv[1]),
+        pathlib.Path(sys.argv[2]),
+        pathlib.Path(sys.argv[3]),
+    )
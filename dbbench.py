@@ -0,0 +1,193 @@
+# Benchmark the database queries used by the server.
+#
+# Compare the optimized database written by build.py with a plain copy of
+# it: no covering indexes, statistics or page size tuning, passages
+# selected with CAST and GLOB, and opened with mode=ro only. Print the
+# query plan and the latency of each query for both.
+#
+#   python3 dbbench.py ./data
+#   python3 dbbench.py ./data --iterations 2000
+
+import argparse
+import json
+import pathlib
+import shutil
+import sqlite3
+import statistics
+import tempfile
+import time
+import typing
+
+_waypoint_fields = (
+    'type, name, notes, comment, ata_num, lon, lat, ele, trail_mile'
+)
+
+
+class Query(typing.NamedTuple):
+    name: str
+    plain: str
+    optimized: str
+    args: tuple
+    # Arguments for the optimized query, if different.
+    optimized_args: tuple | None = None
+
+
+# Number of waypoint types selected for the waypoint queries.
+SELECTED_TYPES = 4
+
+
+def make_queries(type_ids: list[int], type_names: list[str]) -> list[Query]:
+    # Both waypoint queries select the same types: the plain query by name,
+    # as the server did before the type IDs, and the optimized query with a
+    # bitmask of the IDs.
+    mask = sum(1 << i for i in type_ids)
+    names = json.dumps(type_names)
+    return [
+        Query(
+            'passages',
+            """SELECT passage, name, fname, start_mile FROM passages
+               WHERE
+                    passage GLOB '[0-9][0-9]'
+                    AND CAST(passage as INTEGER) >= ?
+                    AND CAST(passage as INTEGER) <= ?
+               ORDER BY passage""",
+            """SELECT passage, name, fname, start_mile FROM passages
+               WHERE num BETWEEN ? AND ?
+               ORDER BY num""",
+            (10, 20),
+        ),
+        Query(
+            'waypoints',
+            f"""SELECT {_waypoint_fields} FROM waypoints
+                WHERE passage = ?
+                    AND type IN (SELECT value FROM json_each(?))
+                ORDER BY trail_mile""",
+            f"""SELECT {_waypoint_fields} FROM waypoints
+                WHERE passage = ? AND (? >> type_id) & 1
+                ORDER BY trail_mile""",
+            ('12', names),
+            ('12', mask),
+        ),
+        Query(
+            'waypoints SOBO',
+            f"""SELECT {_waypoint_fields} FROM waypoints
+                WHERE passage = ?
+                    AND type IN (SELECT value FROM json_each(?))
+                ORDER BY trail_mile DESC""",
+            f"""SELECT {_waypoint_fields} FROM waypoints
+                WHERE passage = ? AND (? >> type_id) & 1
+                ORDER BY trail_mile DESC""",
+            ('12', names),
+            ('12', mask),
+        ),
+        Query(
+            'max passage',
+            'SELECT MAX(CAST(passage as integer)) FROM passages',
+            'SELECT MAX(num) FROM passages',
+            (),
+        ),
+    ]
+
+
+def make_plain(src: pathlib.Path, dst: pathlib.Path) -> None:
+    # Copy of the database with the layout from before the optimization.
+    shutil.copyfile(src, dst)
+    con = sqlite3.connect(dst)
+    for (name,) in con.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index'"
+    ).fetchall():
+        con.execute(f'DROP INDEX {name}')
+    con.execute(
+        'CREATE INDEX waypoint_passage ON waypoints ( passage, trail_mile )'
+    )
+    con.execute('DROP TABLE IF EXISTS sqlite_stat1')
+    con.execute('PRAGMA page_size = 4096')
+    con.execute('VACUUM')
+    con.close()
+
+
+def plan(con: sqlite3.Connection, sql: str, args: tuple) -> list[str]:
+    return [r[3] for r in con.execute(f'EXPLAIN QUERY PLAN {sql}', args)]
+
+
+def timeit(con: sqlite3.Connection, sql: str, args: tuple, n: int) -> float:
+    # Median microseconds to run the query and fetch all rows.
+    samples = []
+    for _ in range(n):
+        t = time.perf_counter()
+        con.execute(sql, args).fetchall()
+        samples.append(time.perf_counter() - t)
+    return statistics.median(samples) * 1e6
+
+
+def run(args) -> None:
+    data = pathlib.Path(args.data)
+    if (data / 'current').exists():
+        data = data / 'current'
+    db = data / 'trail.db'
+    with tempfile.TemporaryDirectory() as tmp:
+        plain_db = pathlib.Path(tmp) / 'plain.db'
+        make_plain(db, plain_db)
+        plain = sqlite3.connect(f'file:{plain_db}?mode=ro', uri=True)
+        optimized = sqlite3.connect(f'file:{db}?mode=ro&immutable=1', uri=True)
+        optimized.execute('PRAGMA mmap_size = 268435456')
+
+        # Every other type, so that the selected IDs are not contiguous.
+        types = optimized.execute(
+            'SELECT id, name FROM waypoint_types ORDER BY id'
+        ).fetchall()[::2][:SELECTED_TYPES]
+        queries = make_queries(
+            [i for i, _ in types], [name for _, name in types]
+        )
+
+        for q in queries:
+            print(q.name)
+            optimized_args = q.optimized_args or q.args
+            results = []
+            for label, con, sql, sql_args in (
+                ('plain', plain, q.plain, q.args),
+                ('optimized', optimized, q.optimized, optimized_args),
+            ):
+                results.append(con.execute(sql, sql_args).fetchall())
+                us = timeit(con, sql, sql_args, args.iterations)
+                print(f'  {label:10} {us:8.1f} us, {len(results[-1])} rows')
+                for line in plan(con, sql, sql_args):
+                    print(f'    {line}')
+            if sorted(results[0]) != sorted(results[1]):
+                print('  results differ')
+
+        print('connect')
+        for label, uri, pragma in (
+            ('plain', f'file:{plain_db}?mode=ro', ''),
+            (
+                'optimized',
+                f'file:{db}?mode=ro&immutable=1',
+                'PRAGMA mmap_size = 268435456',
+            ),
+        ):
+            samples = []
+            for _ in range(args.iterations):
+                t = time.perf_counter()
+                con = sqlite3.connect(uri, uri=True)
+                if pragma:
+                    con.execute(pragma)
+                con.execute(queries[1].plain, queries[1].args).fetchall()
+                con.close()
+                samples.append(time.perf_counter() - t)
+            us = statistics.median(samples) * 1e6
+            print(f'  {label:10} {us:8.1f} us (connect and waypoints query)')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description='Benchmark the database queries.'
+    )
+    parser.add_argument(
+        'data', nargs='?', default='./data', help='data directory'
+    )
+    parser.add_argument('--iterations', type=int, default=1000)
+    run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
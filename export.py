@@ -0,0 +1,242 @@
+# Export downloads to files.
+#
+# Render downloads directly from a data directory in a pool of processes
+# and write them to an output directory with a manifest.json of the file
+# sizes and SHA-256 hashes. The options are the same as the /download
+# query parameters.
+#
+#   python3 export.py --out ./export
+#   python3 export.py --out ./export --start 5 --end -2 --dir SOBO
+#   python3 export.py --out ./export --each --format gpx --format kml
+#   python3 export.py --out ./export --all --cache /var/cache/azt
+#
+# With --cache, the outputs are also compressed and stored in the download
+# disk cache directory, and the manifest has their compressed sizes. Set
+# GAE_VERSION to the version of the deployment that will use the cache.
+
+import argparse
+import concurrent.futures
+import flask
+import gzip
+import hashlib
+import io
+import json
+import os
+import pathlib
+import sys
+import urllib.parse
+import werkzeug.exceptions
+
+FORMATS = ['gpx', 'kml', 'fit']
+
+
+def queries(args) -> list[str]:
+    # Query strings for the downloads selected by args.
+    import main
+
+    data = main.current_data()
+    if args.all_waypoints:
+        wp = list(data.waypoint_types)
+    elif args.wp:
+        ids = {name: i for i, name in data.waypoint_types.items()}
+        unknown = set(args.wp) - ids.keys()
+        if unknown:
+            sys.exit(f'unknown waypoint types: {", ".join(sorted(unknown))}')
+        wp = [ids[name] for name in args.wp]
+    else:
+        wp = [
+            i
+            for i, name in data.waypoint_types.items()
+            if name in main.default_checked_waypoint_types
+        ]
+
+    if args.all:
+        # Each passage and the whole trail.
+        ranges = [(i, 0) for i in range(1, data.max_passage + 1)]
+        ranges.append((1, data.max_passage))
+        directions = ['NOBO', 'SOBO']
+        formats = FORMATS
+    else:
+        start = args.start
+        end = args.end
+        if end <= 0:
+            end = start - end
+        end = min(max(end, start), data.max_passage)
+        if args.each:
+            ranges = [(i, 0) for i in range(start, end + 1)]
+        else:
+            ranges = [(start, end)]
+        directions = ['NOBO', 'SOBO'] if args.dir == 'both' else [args.dir]
+        formats = args.format or ['gpx']
+
+    result = []
+    for start, end in ranges:
+        for direction in directions:
+            for fmt in formats:
+                q = [
+                    ('start', start),
+                    ('end', end),
+                    ('dir', direction),
+                    ('format', fmt),
+                ]
+                q += [('wp', i) for i in wp]
+                if args.max_points:
+                    q.append(('max_points', args.max_points))
+                if args.merge:
+                    q.append(('merge', 1))
+                if args.boundaries:
+                    q.append(('boundaries', 1))
+                result.append(urllib.parse.urlencode(q))
+
+    # Check the options the same way as the server.
+    with main.app.test_request_context(query_string=result[0]):
+        try:
+            main.selected_download(flask.request.args)
+        except werkzeug.exceptions.HTTPException as e:
+            sys.exit(e.description)
+    return result
+
+
+def export(query: str, out: pathlib.Path, cache: str) -> dict:
+    # Render the download for query and write it to out. Return the manifest
+    # entry for the file.
+    import filecache
+    import main
+
+    body = None
+    with main.app.test_request_context(query_string=query):
+        dl = main.selected_download(flask.request.args)
+        if cache:
+            # The cache stores the compressed output of the server.
+            body = main.render_download(dl)
+            data = gzip.decompress(body)
+        else:
+            f = io.BytesIO()
+            main.write_download(f, dl)
+            data = f.getvalue()
+        name = dl.filename()
+    if dl.reverse:
+        stem, _, ext = name.rpartition('.')
+        name = f'{stem}-sobo.{ext}'
+    (out / name).write_bytes(data)
+    entry = dict(
+        file=name,
+        query=query,
+        size=len(data),
+        sha256=hashlib.sha256(data).hexdigest(),
+    )
+    if body is not None:
+        filecache.Cache(pathlib.Path(cache), main.DOWNLOAD_CACHE_BYTES).put(
+            dl.key(), body
+        )
+        entry['gzip_size'] = len(body)
+    return entry
+
+
+def _init() -> None:
+    # Compress in one thread in each process. The pool of processes already
+    # uses the CPUs.
+    import blockgzip
+
+    blockgzip.THREADS = 1
+
+
+def run(args) -> None:
+    # main reads DATA_DIR when it is imported.
+    os.environ['DATA_DIR'] = str(pathlib.Path(args.data).resolve())
+    out = pathlib.Path(args.out)
+    out.mkdir(parents=True, exist_ok=True)
+
+    qs = queries(args)
+    with concurrent.futures.ProcessPoolExecutor(
+        args.jobs, initializer=_init
+    ) as pool:
+        futures = [pool.submit(export, q, out, args.cache) for q in qs]
+        manifest = []
+        for f in futures:
+            entry = f.result()
+            manifest.append(entry)
+            print(f'{entry["file"]} {entry["size"]}', file=sys.stderr)
+
+    import main
+
+    with (out / 'manifest.json').open('w') as f:
+        json.dump(
+            dict(version=main.current_data().version, files=manifest),
+            f,
+            indent=1,
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Export downloads to files.')
+    parser.add_argument('--out', required=True, help='output directory')
+    parser.add_argument(
+        '--data', default='./data', help='data directory (default ./data)'
+    )
+    parser.add_argument('--start', type=int, default=1, help='start passage')
+    parser.add_argument(
+        '--end',
+        type=int,
+        default=0,
+        help='end passage, or start minus END if not positive (default 0)',
+    )
+    parser.add_argument(
+        '--each',
+        action='store_true',
+        help='export each passage from start to end to its own file',
+    )
+    parser.add_argument(
+        '--dir', choices=['NOBO', 'SOBO', 'both'], default='NOBO'
+    )
+    parser.add_argument(
+        '--format',
+        action='append',
+        choices=FORMATS,
+        help='output format, repeat for more than one (default gpx)',
+    )
+    parser.add_argument(
+        '--wp',
+        action='append',
+        metavar='TYPE',
+        help='waypoint type to include, repeat for more than one '
+        '(default: the types checked on the index page)',
+    )
+    parser.add_argument(
+        '--all-waypoints',
+        action='store_true',
+        help='include all waypoint types',
+    )
+    parser.add_argument(
+        '--max-points', type=int, default=0, help='maximum points per track'
+    )
+    parser.add_argument(
+        '--merge',
+        action='store_true',
+        help='render the passages of a file as a single track',
+    )
+    parser.add_argument(
+        '--boundaries',
+        action='store_true',
+        help='mark the start of each passage in a single track',
+    )
+    parser.add_argument(
+        '--all',
+        action='store_true',
+        help='export each passage and the whole trail in both directions '
+        'and all formats',
+    )
+    parser.add_argument(
+        '--jobs',
+        type=int,
+        default=os.cpu_count() or 1,
+        help='number of processes',
+    )
+    parser.add_argument(
+        '--cache', default='', help='also store outputs in this disk cache'
+    )
+    run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+# Disk cache for rendered downloads.
+#
+# Each entry is a file in the cache directory named by the SHA-256 of its
+# key. Entries are written to a temporary file and renamed into place, so
+# readers never see a partial entry, and several processes or instances can
+# share the directory. The modification time of an entry is updated on each
+# hit. When the size of the entries is over the limit, the least recently
+# used entries are removed.
+#
+# Because the cache is on disk, a new instance serves popular downloads
+# from the entries written before it started instead of rendering them.
+
+import hashlib
+import logging
+import os
+import pathlib
+import tempfile
+import threading
+import typing
+
+_log = logging.getLogger(__name__)
+
+# Remove entries until the size is at most this fraction of the limit, so
+# that eviction does not run on every write.
+_LOW_WATER = 0.9
+
+
+class Cache:
+    def __init__(self, path: pathlib.Path, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        path.mkdir(parents=True, exist_ok=True)
+        self._size = sum(size for _, _, size in self._entries())
+
+    def _file(self, key: str) -> pathlib.Path:
+        return self.path / hashlib.sha256(key.encode()).hexdigest()
+
+    def _entries(self) -> list[tuple[float, pathlib.Path, int]]:
+        # (mtime, path, size) for each entry.
+        result = []
+        with os.scandir(self.path) as it:
+            for e in it:
+                if e.name.startswith('.') or not e.is_file():
+                    continue
+                try:
+                    st = e.stat()
+                except FileNotFoundError:
+                    continue
+                result.append((st.st_mtime, pathlib.Path(e.path), st.st_size))
+        return result
+
+    def get(self, key: str) -> typing.BinaryIO | None:
+        # Return the entry for key open for reading, or None if the key is not
+        # cached. The open file can be read after the entry is evicted.
+        path = self._file(key)
+        try:
+            f = path.open('rb')
+        except FileNotFoundError:
+            return None
+        try:
+            os.utime(f.fileno())
+        except OSError:
+            pass
+        return f
+
+    def put(self, key: str, data: bytes) -> None:
+        # Store data for key. Errors are logged and otherwise ignored.
+        try:
+            fd, tmp = tempfile.mkstemp(dir=self.path, prefix='.')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp, self._file(key))
+            except BaseException:
+                os.unlink(tmp)
+                raise
+        except OSError:
+            _log.exception('cache write failed')
+            return
+        with self._lock:
+            self._size += len(data)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self) -> None:
+        # Other processes also write to the directory, so recompute the
+        # size from the entries.
+        entries = sorted(self._entries())
+        size = sum(size for _, _, size in entries)
+        for _, f, n in entries:
+            if size <= self.max_bytes * _LOW_WATER:
+                break
+            f.unlink(missing_ok=True)
+            size -= n
+        self._size = size
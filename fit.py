@@ -0,0 +1,312 @@
+# FIT course files.
+#
+# See the FIT protocol and the course file type in the FIT SDK. A course
+# file has file_id, course, lap, event, record and course_point messages.
+# Records for the track points are packed with a single struct call.
+
+import struct
+import geo
+import tiles
+
+# Seconds from the Unix epoch to the FIT epoch, 1989-12-31 00:00:00 UTC.
+_FIT_EPOCH = 631065600
+
+# Course start time. A fixed time keeps the output deterministic.
+_START_TIME = 1704067200 - _FIT_EPOCH  # 2024-01-01 00:00:00 UTC
+
+# Hiking speed in meters per second for record and course point timestamps.
+_SPEED = 1.34
+
+_METERS_PER_MILE = 1609.344
+
+_NAME_SIZE = 16
+
+# Course point types for waypoint types. Other types are generic.
+course_point_types = {
+    'Bridge': 45,
+    'Campground': 27,
+    'Milepost': 34,
+    'Tunnel': 44,
+    'Water': 3,
+}
+
+# Base types.
+_ENUM = 0x00
+_UINT16 = 0x84
+_SINT32 = 0x85
+_UINT32 = 0x86
+_STRING = 0x07
+_UINT32Z = 0x8C
+
+# Message numbers.
+_FILE_ID = 0
+_LAP = 19
+_RECORD = 20
+_EVENT = 21
+_COURSE = 31
+_COURSE_POINT = 32
+
+_crc_table = []
+for _i in range(256):
+    _c = _i
+    for _ in range(8):
+        _c = (_c >> 1) ^ 0xA001 if _c & 1 else _c >> 1
+    _crc_table.append(_c)
+
+
+def crc(data: bytes, value: int = 0) -> int:
+    table = _crc_table
+    for b in data:
+        value = (value >> 8) ^ table[(value ^ b) & 0xFF]
+    return value
+
+
+def _semicircles(deg: float) -> int:
+    return round(deg * (2**31 / 180))
+
+
+class _Message(struct.Struct):
+    # A local message type with its definition.
+
+    def __init__(self, local: int, number: int, fields):
+        # fields is a list of (field number, base type, size).
+        self.local = local
+        self.definition = struct.pack(
+            '<BBBHB', 0x40 | local, 0, 0, number, len(fields)
+        ) + b''.join(
+            struct.pack('<BBB', num, size, base) for num, base, size in fields
+        )
+        codes = {
+            _ENUM: 'B',
+            _UINT16: 'H',
+            _SINT32: 'i',
+            _UINT32: 'I',
+            _UINT32Z: 'I',
+        }
+        super().__init__(
+            '<B'
+            + ''.join(
+                f'{size}s' if base == _STRING else codes[base]
+                for _, base, size in fields
+            )
+        )
+
+    def data(self, *values) -> bytes:
+        return self.pack(self.local, *values)
+
+
+_file_id = _Message(
+    0,
+    _FILE_ID,
+    [
+        (0, _ENUM, 1),  # type
+        (1, _UINT16, 2),  # manufacturer
+        (2, _UINT16, 2),  # product
+        (3, _UINT32Z, 4),  # serial_number
+        (4, _UINT32, 4),  # time_created
+    ],
+)
+
+_course = _Message(
+    1,
+    _COURSE,
+    [
+        (4, _ENUM, 1),  # sport
+        (5, _STRING, 32),  # name
+    ],
+)
+
+_lap = _Message(
+    2,
+    _LAP,
+    [
+        (253, _UINT32, 4),  # timestamp
+        (2, _UINT32, 4),  # start_time
+        (3, _SINT32, 4),  # start_position_lat
+        (4, _SINT32, 4),  # start_position_long
+        (5, _SINT32, 4),  # end_position_lat
+        (6, _SINT32, 4),  # end_position_long
+        (7, _UINT32, 4),  # total_elapsed_time
+        (8, _UINT32, 4),  # total_timer_time
+        (9, _UINT32, 4),  # total_distance
+    ],
+)
+
+_event = _Message(
+    3,
+    _EVENT,
+    [
+        (253, _UINT32, 4),  # timestamp
+        (0, _ENUM, 1),  # event
+        (1, _ENUM, 1),  # event_type
+    ],
+)
+
+_record = _Message(
+    4,
+    _RECORD,
+    [
+        (253, _UINT32, 4),  # timestamp
+        (0, _SINT32, 4),  # position_lat
+        (1, _SINT32, 4),  # position_long
+        (2, _UINT16, 2),  # altitude
+        (5, _UINT32, 4),  # distance
+    ],
+)
+
+_course_point = _Message(
+    5,
+    _COURSE_POINT,
+    [
+        (254, _UINT16, 2),  # message_index
+        (1, _UINT32, 4),  # timestamp
+        (2, _SINT32, 4),  # position_lat
+        (3, _SINT32, 4),  # position_long
+        (4, _UINT32, 4),  # distance
+        (5, _ENUM, 1),  # type
+        (6, _STRING, _NAME_SIZE),  # name
+    ],
+)
+
+
+def _string(s: str, size: int) -> bytes:
+    # Null terminated UTF-8 truncated to size bytes.
+    b = s.encode('utf-8')[: size - 1]
+    return b.decode('utf-8', 'ignore').encode('utf-8')
+
+
+def _altitude(ele: float) -> int:
+    return min(0xFFFE, max(0, round((ele + 500) * 5)))
+
+
+def _simplify(rows, max_points: int):
+    # Simplify with increasing tolerance until there are at most max_points
+    # rows.
+    tol = tiles.tolerance(20)
+    while True:
+        simplified = tiles.simplify(rows, tol)
+        if len(simplified) <= max_points:
+            return simplified
+        tol *= 2
+
+
+def course(
+    write,
+    name,
+    passages,
+    waypoint_mask,
+    reverse,
+    max_points=0,
+    merge=False,
+    boundaries=False,
+) -> None:
+    # Write a FIT course file for the passages. A FIT course has a single
+    # track, so merge is ignored. If max_points is not zero, the track is
+    # simplified to at most max_points points. If boundaries is true, the start
+    # of each passage after the first is a course point.
+    _ = merge
+    passages = list(reversed(passages)) if reverse else passages
+
+    points = []
+    # Index of the first point of each passage in points.
+    starts = []
+    for passage in passages:
+        track = passage.coords()
+        if reverse:
+            track.reverse()
+        # Drop the shared end point at passage boundaries.
+        if points and track and points[-1][:2] == track[0][:2]:
+            starts.append(len(points) - 1)
+            track = track[1:]
+        else:
+            starts.append(len(points))
+        points.extend(track)
+    starts.append(len(points) - 1)
+
+    meters = [m * _METERS_PER_MILE for m in geo.miles(points)]
+
+    # Course point distances are from the along trail mile of the waypoint
+    # relative to the start of its passage.
+    # (distance, name, waypoint type, lat, lon)
+    course_points = []
+    for i, passage in enumerate(passages):
+        start = meters[starts[i]]
+        length = meters[starts[i + 1]] - start
+        if boundaries and i > 0:
+            lon, lat, _ = points[starts[i]]
+            course_points.append(
+                (start, f'Passage {passage.formatted_name()}', '', lat, lon)
+            )
+        for p in passage.waypoints(waypoint_mask, reverse):
+            d = (p.mile - passage.start_mile) * _METERS_PER_MILE
+            if reverse:
+                d = length - d
+            course_points.append(
+                (
+                    start + min(length, max(0.0, d)),
+                    p.name,
+                    p.type,
+                    p.lat,
+                    p.lon,
+                )
+            )
+
+    rows = [(lon, lat, ele, d) for (lon, lat, ele), d in zip(points, meters)]
+    if max_points > 0 and len(rows) > max_points:
+        rows = _simplify(rows, max_points)
+
+    body = bytearray()
+    for m in (_file_id, _course, _lap, _event, _record, _course_point):
+        body += m.definition
+    body += _file_id.data(6, 255, 0, 1, _START_TIME)
+    body += _course.data(17, _string(name, 32))
+
+    total = meters[-1] if meters else 0.0
+    end_time = _START_TIME + round(total / _SPEED)
+    first = rows[0] if rows else (0.0, 0.0)
+    last = rows[-1] if rows else (0.0, 0.0)
+    body += _lap.data(
+        end_time,
+        _START_TIME,
+        _semicircles(first[1]),
+        _semicircles(first[0]),
+        _semicircles(last[1]),
+        _semicircles(last[0]),
+        (end_time - _START_TIME) * 1000,
+        (end_time - _START_TIME) * 1000,
+        round(total * 100),
+    )
+    # Timer start.
+    body += _event.data(_START_TIME, 0, 0)
+
+    values = []
+    for lon, lat, ele, d in rows:
+        values += (
+            _record.local,
+            _START_TIME + round(d / _SPEED),
+            _semicircles(lat),
+            _semicircles(lon),
+            _altitude(ele),
+            round(d * 100),
+        )
+    body += struct.pack('<' + _record.format[1:] * len(rows), *values)
+
+    for i, (d, cp_name, cp_type, lat, lon) in enumerate(course_points):
+        body += _course_point.data(
+            i,
+            _START_TIME + round(d / _SPEED),
+            _semicircles(float(lat)),
+            _semicircles(float(lon)),
+            round(d * 100),
+            course_point_types.get(cp_type, 0),
+            _string(cp_name, _NAME_SIZE),
+        )
+
+    # Timer stop all.
+    body += _event.data(end_time, 0, 9)
+
+    header = struct.pack('<BBHI4s', 14, 0x10, 2132, len(body), b'.FIT')
+    header += struct.pack('<H', crc(header))
+    write(header)
+    write(bytes(body))
+    write(struct.pack('<H', crc(body, crc(header))))
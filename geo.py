@@ -0,0 +1,127 @@
+# Distances and nearest point queries on the trail.
+
+from collections import abc
+import math
+
+EARTH_RADIUS_MILES = 3958.8
+
+
+def distance(lon1: float, lat1: float, lon2: float, lat2: float) -> float:
+    # Great circle distance in miles.
+    p1 = math.radians(lat1)
+    p2 = math.radians(lat2)
+    dp = p2 - p1
+    dl = math.radians(lon2 - lon1)
+    a = (
+        math.sin(dp / 2) ** 2
+        + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_MILES * math.asin(min(1.0, math.sqrt(a)))
+
+
+def miles(
+    points: abc.Sequence[tuple[float, ...]], start_mile: float = 0.0
+) -> list[float]:
+    # Along line mile at each point.
+    result = [start_mile]
+    for i in range(1, len(points)):
+        a = points[i - 1]
+        b = points[i]
+        result.append(result[-1] + distance(a[0], a[1], b[0], b[1]))
+    return result
+
+
+class Track:
+    # A line with along track mileage and a grid index of its segments.
+    # Coordinates are projected to an equirectangular plane centered on the
+    # track for nearest segment queries. Each grid cell lists the segments
+    # whose bounding box overlaps the cell.
+
+    def __init__(
+        self,
+        points: abc.Sequence[tuple[float, float]],
+        start_mile: float = 0.0,
+        cell: float = 0.01,
+    ):
+        self.lons = [p[0] for p in points]
+        self.lats = [p[1] for p in points]
+        self.miles = miles(points, start_mile)
+        lat0 = sum(self.lats) / len(self.lats) if points else 0.0
+        self._kx = math.cos(math.radians(lat0))
+        self._cell = cell
+        self._grid: dict[tuple[int, int], list[int]] = {}
+        for i in range(len(points) - 1):
+            x1, y1 = self._xy(self.lons[i], self.lats[i])
+            x2, y2 = self._xy(self.lons[i + 1], self.lats[i + 1])
+            for cx in range(self._c(min(x1, x2)), self._c(max(x1, x2)) + 1):
+                for cy in range(
+                    self._c(min(y1, y2)), self._c(max(y1, y2)) + 1
+                ):
+                    self._grid.setdefault((cx, cy), []).append(i)
+        if self._grid:
+            cxs = [c[0] for c in self._grid]
+            cys = [c[1] for c in self._grid]
+            self._extent = (min(cxs), min(cys), max(cxs), max(cys))
+
+    def _xy(self, lon: float, lat: float) -> tuple[float, float]:
+        return lon * self._kx, lat
+
+    def _c(self, v: float) -> int:
+        return math.floor(v / self._cell)
+
+    def _ring(self, cx: int, cy: int, r: int) -> abc.Iterator[int]:
+        # Segments in the cells at distance r from (cx, cy), limited to the
+        # extent of the grid.
+        x0, y0, x1, y1 = self._extent
+        grid = self._grid
+        for y in (cy - r, cy + r) if r else (cy,):
+            if y0 <= y <= y1:
+                for x in range(max(x0, cx - r), min(x1, cx + r) + 1):
+                    yield from grid.get((x, y), ())
+        for x in (cx - r, cx + r) if r else ():
+            if x0 <= x <= x1:
+                for y in range(max(y0, cy - r + 1), min(y1, cy + r - 1) + 1):
+                    yield from grid.get((x, y), ())
+
+    def nearest(self, lon: float, lat: float) -> tuple[float, float]:
+        # Return the along track mile and distance in miles to the nearest
+        # point on the track.
+        if not self._grid:
+            return self.miles[0], distance(
+                lon, lat, self.lons[0], self.lats[0]
+            )
+        x, y = self._xy(lon, lat)
+        cx = self._c(x)
+        cy = self._c(y)
+        x0, y0, x1, y1 = self._extent
+        max_r = max(abs(cx - x0), abs(cx - x1), abs(cy - y0), abs(cy - y1))
+        best_d2 = math.inf
+        best = (0, 0.0)
+        seen: set[int] = set()
+        for r in range(max_r + 1):
+            for i in self._ring(cx, cy, r):
+                if i in seen:
+                    continue
+                seen.add(i)
+                ax, ay = self._xy(self.lons[i], self.lats[i])
+                bx, by = self._xy(self.lons[i + 1], self.lats[i + 1])
+                dx = bx - ax
+                dy = by - ay
+                dd = dx * dx + dy * dy
+                t = 0.0
+                if dd > 0:
+                    t = min(
+                        1.0, max(0.0, ((x - ax) * dx + (y - ay) * dy) / dd)
+                    )
+                d2 = (x - ax - t * dx) ** 2 + (y - ay - t * dy) ** 2
+                if d2 < best_d2:
+                    best_d2 = d2
+                    best = (i, t)
+            # Segments in cells outside ring r are at least r cells away.
+            if best_d2 <= (r * self._cell) ** 2:
+                break
+        i, t = best
+        mile = self.miles[i] + t * (self.miles[i + 1] - self.miles[i])
+        plon = self.lons[i] + t * (self.lons[i + 1] - self.lons[i])
+        plat = self.lats[i] + t * (self.lats[i + 1] - self.lats[i])
+        return mile, distance(lon, lat, plon, plat)
@@ -0,0 +1,405 @@
+# Load test the server.
+#
+# Start the server on a local port against a data directory, replay a
+# weighted mix of requests at the configured concurrency, and report
+# throughput, latency percentiles, response sizes and server memory.
+#
+#   python3 loadtest.py --data ./data
+#   python3 loadtest.py --synthetic /tmp/azt-data --concurrency 32
+#   python3 loadtest.py --data ./data --log access.jsonl
+#
+# Each line of the log is a JSON object with a "path" field, an optional
+# "query" field and an optional "weight" field. The query is added to the
+# path, so the access log written by accesslog.py can be replayed. A path
+# may also include the query itself. Lines without a path are ignored.
+#
+# The --synthetic option builds a data directory from generated shapefiles
+# with build.py. It requires pyshp.
+
+import argparse
+import json
+import math
+import os
+import pathlib
+import random
+import shlex
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import typing
+import urllib.error
+import urllib.request
+
+REPO_DIR = pathlib.Path(__file__).resolve().parent
+
+# Waypoint types to select for a typical download.
+_default_types = {'Trailhead', 'Water', 'Highway Jct', 'Landmark'}
+
+_synthetic_types = [
+    'Campground',
+    'Gate',
+    'Highway Jct',
+    'Landmark',
+    'Milepost',
+    'Road Jct',
+    'Trail Jct',
+    'Trailhead',
+    'Water',
+]
+
+
+def make_synthetic(dst: pathlib.Path, passages: int = 43) -> None:
+    # Build a data directory from generated shapefiles.
+    import shapefile
+    import build
+
+    rng = random.Random(1)
+    with tempfile.TemporaryDirectory() as tmp:
+        src = pathlib.Path(tmp)
+        w = shapefile.Writer(
+            str(src / 'passages'), shapeType=shapefile.POLYLINEZ
+        )
+        for name, _, record_field in build.passage_columns:
+            if record_field:
+                w.field(record_field, 'C', 50)
+        lon, lat = -111.0, 31.3
+        tracks = []
+        for i in range(1, passages + 1):
+            points = []
+            for j in range(2000):
+                points.append([lon, lat, 1200 + 300 * math.sin(j / 100)])
+                lon += rng.uniform(-0.0002, 0.0002)
+                lat += 0.0001
+            # Passages share their end points.
+            lon, lat, _ = points[-1]
+            tracks.append(points)
+            w.linez([points])
+            name = 'Flagstaff' if i == passages * 3 // 4 else f'Passage {i}'
+            w.record(f'{i:02d}', name, '', '', '', '', '', '', '')
+        w.close()
+
+        w = shapefile.Writer(
+            str(src / 'waypoints'), shapeType=shapefile.POINTZ
+        )
+        for name, _, record_field in build.waypoint_columns:
+            if record_field:
+                w.field(record_field, 'C', 50)
+        for i, points in enumerate(tracks, 1):
+            for k in range(40):
+                t = rng.choice(_synthetic_types)
+                p = rng.choice(points)
+                w.pointz(p[0] + rng.uniform(-0.001, 0.001), p[1], p[2])
+                w.record(
+                    t,
+                    f'{t} {i}-{k}',
+                    f'{i}.{k}',
+                    'note',
+                    f'{t} {i}-{k} comment',
+                    f'{i:02d}',
+                    '',
+                    '',
+                    '',
+                    '',
+                    f'{i * 100 + k}',
+                )
+        w.close()
+
+        build.run(dst, src / 'passages', src / 'waypoints')
+
+
+class Mix:
+    # Weighted random request paths.
+
+    def __init__(self, paths: list[str], weights: list[float]):
+        self.paths = paths
+        self.weights = weights
+
+    def sample(self, rng: random.Random, n: int) -> list[str]:
+        return rng.choices(self.paths, self.weights, k=n)
+
+
+def data_db(data: pathlib.Path) -> pathlib.Path:
+    # The database in a versioned or unversioned data directory.
+    if (data / 'current').exists():
+        data = data / 'current'
+    return data / 'trail.db'
+
+
+def synthetic_mix(data: pathlib.Path) -> Mix:
+    con = sqlite3.connect(f'file:{data_db(data)}?mode=ro', uri=True)
+    max_passage = con.execute(
+        'SELECT MAX(CAST(passage as integer)) FROM passages'
+    ).fetchone()[0]
+    types = dict(con.execute('SELECT id, name FROM waypoint_types'))
+    con.close()
+    default_wp = ''.join(
+        f'&wp={i}' for i, t in types.items() if t in _default_types
+    )
+    all_wp = ''.join(f'&wp={i}' for i in types)
+
+    paths = []
+    weights = []
+    for start in range(1, max_passage + 1):
+        for end, w_end in (('0', 6), ('-1', 2), ('-3', 1), ('100', 1)):
+            for direction, w_dir in (('NOBO', 2), ('SOBO', 1)):
+                for fmt, w_fmt in (('gpx', 3), ('kml', 1)):
+                    for wp, w_wp in ((default_wp, 4), (all_wp, 1)):
+                        paths.append(
+                            f'/download?start={start}&end={end}'
+                            f'&dir={direction}&format={fmt}{wp}'
+                        )
+                        weights.append(w_end * w_dir * w_fmt * w_wp)
+    # The index page is 40% of requests.
+    paths.append('/')
+    weights.append(sum(weights) * 40 / 60)
+    return Mix(paths, weights)
+
+
+def log_mix(path: pathlib.Path) -> Mix:
+    paths = []
+    weights = []
+    with path.open('r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line)
+            if not isinstance(entry, dict) or 'path' not in entry:
+                continue
+            p = entry['path']
+            if entry.get('query'):
+                p = f'{p}?{entry["query"]}'
+            paths.append(p)
+            weights.append(float(entry.get('weight', 1)))
+    if not paths:
+        sys.exit(f'{path}: no requests with a path field')
+    return Mix(paths, weights)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(
+    command: str | None, data: pathlib.Path, port: int
+) -> subprocess.Popen:
+    if command:
+        args = shlex.split(command.format(port=port))
+    else:
+        args = [
+            sys.executable,
+            '-c',
+            'import main; '
+            f'main.app.run(host="127.0.0.1", port={port}, threaded=True)',
+        ]
+    env = dict(os.environ, DATA_DIR=str(data.resolve()))
+    proc = subprocess.Popen(
+        args,
+        cwd=REPO_DIR,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            sys.exit(f'server exited with status {proc.returncode}')
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/').read()
+            return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    sys.exit('server did not start')
+
+
+def rss(pid: int) -> int | None:
+    # Resident set size of process and its children in bytes. Return None if
+    # not known.
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            n = next(
+                int(line.split()[1]) * 1024
+                for line in f
+                if line.startswith('VmRSS:')
+            )
+        tasks = os.listdir(f'/proc/{pid}/task')
+    except (OSError, StopIteration):
+        return None
+    # Children are listed by the thread that started them, such as the
+    # render pool started from a request thread.
+    children = []
+    for task in tasks:
+        try:
+            with open(f'/proc/{pid}/task/{task}/children') as f:
+                children += [int(c) for c in f.read().split()]
+        except OSError:
+            # The thread exited.
+            continue
+    return n + sum(rss(c) or 0 for c in children)
+
+
+class Result(typing.NamedTuple):
+    path: str
+    status: int
+    seconds: float
+    size: int
+
+
+def fetch(base: str, path: str) -> Result:
+    req = urllib.request.Request(
+        base + path, headers={'Accept-Encoding': 'gzip'}
+    )
+    t = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req) as resp:
+            status = resp.status
+            size = len(resp.read())
+    except urllib.error.HTTPError as e:
+        status = e.code
+        size = len(e.read())
+    return Result(path, status, time.perf_counter() - t, size)
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def report(results: list[Result], elapsed: float, rss_samples: list[int]):
+    latencies = [r.seconds for r in results]
+    sizes = [r.size for r in results]
+    errors = sum(1 for r in results if r.status >= 400)
+    print(f'requests    {len(results)} ({errors} errors)')
+    statuses: dict[int, int] = {}
+    for r in results:
+        statuses[r.status] = statuses.get(r.status, 0) + 1
+    print(f'statuses    {dict(sorted(statuses.items()))}')
+    print(f'elapsed     {elapsed:.2f} s')
+    print(f'throughput  {len(results) / elapsed:.1f} req/s')
+    for p in (50, 95, 99):
+        print(f'p{p}         {percentile(latencies, p) * 1000:.1f} ms')
+    print(f'max         {max(latencies, default=0) * 1000:.1f} ms')
+    print(f'mean size   {sum(sizes) / max(1, len(sizes)) / 1024:.1f} KiB')
+    print(f'total size  {sum(sizes) / 1024 / 1024:.1f} MiB')
+    if rss_samples:
+        print(f'server RSS  {rss_samples[-1] / 1024 / 1024:.1f} MiB', end='')
+        print(f' (max {max(rss_samples) / 1024 / 1024:.1f} MiB)')
+    else:
+        print('server RSS  unknown')
+
+    by_route: dict[str, list[float]] = {}
+    for r in results:
+        by_route.setdefault(r.path.partition('?')[0], []).append(r.seconds)
+    for route, values in sorted(by_route.items()):
+        print(
+            f'  {route:12} n={len(values):<6}'
+            f' p50={percentile(values, 50) * 1000:.1f} ms'
+            f' p99={percentile(values, 99) * 1000:.1f} ms'
+        )
+
+
+def run(args) -> None:
+    if args.synthetic:
+        data = pathlib.Path(args.synthetic)
+        if not data_db(data).exists():
+            print(f'building synthetic data in {data}', file=sys.stderr)
+            make_synthetic(data)
+    else:
+        data = pathlib.Path(args.data)
+
+    mix = log_mix(pathlib.Path(args.log)) if args.log else synthetic_mix(data)
+    rng = random.Random(args.seed)
+    paths = mix.sample(rng, args.requests)
+
+    port = free_port()
+    proc = start_server(args.command, data, port)
+    base = f'http://127.0.0.1:{port}'
+    try:
+        for path in paths[: args.warmup]:
+            fetch(base, path)
+
+        results: list[Result] = []
+        lock = threading.Lock()
+        next_index = 0
+        rss_samples: list[int] = []
+        done = threading.Event()
+
+        def worker():
+            nonlocal next_index
+            while True:
+                with lock:
+                    i = next_index
+                    next_index += 1
+                if i >= len(paths):
+                    return
+                r = fetch(base, paths[i])
+                with lock:
+                    results.append(r)
+
+        def sample_rss():
+            while not done.wait(0.2):
+                n = rss(proc.pid)
+                if n is not None:
+                    rss_samples.append(n)
+
+        sampler = threading.Thread(target=sample_rss, daemon=True)
+        sampler.start()
+        t = time.perf_counter()
+        threads = [
+            threading.Thread(target=worker) for _ in range(args.concurrency)
+        ]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        elapsed = time.perf_counter() - t
+        done.set()
+        sampler.join()
+        n = rss(proc.pid)
+        if n is not None:
+            rss_samples.append(n)
+        report(results, elapsed, rss_samples)
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Load test the server.')
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument(
+        '--data', default='./data', help='data directory (default ./data)'
+    )
+    source.add_argument(
+        '--synthetic',
+        metavar='DIR',
+        help='build synthetic data in DIR if not present and use it',
+    )
+    parser.add_argument(
+        '--log', help='JSON lines file with request paths to replay'
+    )
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument(
+        '--warmup', type=int, default=20, help='requests before measuring'
+    )
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument(
+        '--command',
+        help='server command with {port} placeholder, run in the '
+        'repository directory (default: Flask threaded server)',
+    )
+    run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,56 @@
 from collections import abc
+import accesslog
+import bisect
+import blockgzip
+import collections
 import csv
+import filecache
 import flask
+import functools
+import geo
 import gzip
+import hashlib
 import io
+import json
+import math
+import os
 import pathlib
+import re
 import sqlite3
+import threading
+import time
 import typing
+import werkzeug.wsgi
+import fit
+import polyline
+import render
+import singleflight
+import tags
+import tiles
+import trackstore
 import templates
+import zipstream
+
+if __name__ == '__main__':
+    # Run the application from the module main, not from __main__. Objects
+    # pickled for the render worker processes, and exceptions raised by the
+    # workers, then refer to the same module in the server and the workers.
+    import main
+
+    # Flask's development server automatically serves static files from
+    # /static.
+    main.app.run(host='127.0.0.1', port=8080, debug=True)
+    raise SystemExit
 
 app = flask.Flask(__name__)
-DATA_DIR = pathlib.Path('./data')
+accesslog.init_app(app)
+DATA_DIR = pathlib.Path(os.environ.get('DATA_DIR', './data'))
+# Seconds between checks for a new data version.
+RELOAD_INTERVAL = float(os.environ.get('DATA_RELOAD_INTERVAL', '5'))
+# Directory for the disk cache of rendered downloads. Empty disables the
+# cache.
+DOWNLOAD_CACHE_DIR = os.environ.get('DOWNLOAD_CACHE_DIR', '')
+DOWNLOAD_CACHE_BYTES = int(os.environ.get('DOWNLOAD_CACHE_BYTES', 1 << 30))
 default_checked_waypoint_types = {
     'Boundary',
     'Bridge',
@@ -25,14 +66,196 @@ default_checked_waypoint_types = {
 }
 
 
+class Data(typing.NamedTuple):
+    # A version of the data files.
+    #
+    # build.py writes each version to a new directory under
+    # DATA_DIR/versions and then atomically points the DATA_DIR/current
+    # symlink at it. A DATA_DIR without current is a single unversioned
+    # data directory, identified by the modification time and size of
+    # trail.db.
+    version: str
+    path: pathlib.Path
+    # Waypoint type names by ID.
+    waypoint_types: dict[int, str]
+    flagstaff_passage: int
+    max_passage: int
+    # Tracks as packed arrays shared by all processes, or None if the data
+    # was built without them.
+    tracks: trackstore.Store | None
+
+
+def data_path() -> pathlib.Path:
+    current = DATA_DIR / 'current'
+    return current.resolve() if current.exists() else DATA_DIR
+
+
+def data_version(path: pathlib.Path) -> str:
+    if path.parent.name == 'versions':
+        return path.name
+    st = (path / 'trail.db').stat()
+    return f'{st.st_mtime_ns:x}-{st.st_size:x}'
+
+
+# Bytes of the database to memory map.
+MMAP_SIZE = 256 * 1024 * 1024
+
+
+def connect(path: pathlib.Path) -> sqlite3.Connection:
+    # The database is never modified after it is built. Open it as
+    # immutable so that SQLite skips locking and change detection.
+    con = sqlite3.connect(
+        f'file:{path / "trail.db"}?mode=ro&immutable=1', uri=True
+    )
+    con.execute(f'PRAGMA mmap_size = {MMAP_SIZE}')
+    return con
+
+
+def load_data(path: pathlib.Path) -> Data:
+    version = data_version(path)
+    con = connect(path)
+    try:
+        waypoint_types = dict(
+            con.execute('SELECT id, name FROM waypoint_types ORDER BY name')
+        )
+        flagstaff_passage = con.execute(
+            """SELECT num FROM passages WHERE name = 'Flagstaff'"""
+        ).fetchone()[0]
+        max_passage = con.execute(
+            """SELECT MAX(num) FROM passages"""
+        ).fetchone()[0]
+        tracks = trackstore.open_store(path, con)
+    finally:
+        con.close()
+    return Data(
+        version=version,
+        path=path,
+        waypoint_types=waypoint_types,
+        flagstaff_passage=flagstaff_passage,
+        max_passage=max_passage,
+        tracks=tracks,
+    )
+
+
+# The current data version. Requests use the version that was current when
+# the request started.
+data = load_data(data_path())
+# Guards data and inflight. Held only to swap or count versions, never
+# while a version is loaded.
+data_lock = threading.Lock()
+# Held by the thread that checks for and loads a new version.
+reload_lock = threading.Lock()
+last_reload_check = time.monotonic()
+# Number of requests in progress for each data version.
+inflight: collections.Counter[str] = collections.Counter()
+
+
+def current_data() -> Data:
+    if flask.has_app_context():
+        d = getattr(flask.g, '_data', None)
+        if d is None:
+            d = flask.g._data = data
+        return d
+    return data
+
+
+class VersionGone(Exception):
+    # The data version of a download was removed before it was rendered.
+    pass
+
+
+def version_path(version: str) -> pathlib.Path:
+    # Directory for a data version. Raise VersionGone if it was removed.
+    path = DATA_DIR / 'versions' / version
+    if path.is_dir():
+        return path
+    # Data that is not versioned has only the current version.
+    path = data_path()
+    if data_version(path) != version:
+        raise VersionGone(version)
+    return path
+
+
+def reload_data(path: pathlib.Path | None = None) -> bool:
+    # Switch to the data version at path, or to the current version if path
+    # is None. Return True if the version changed.
+    global data, index_page
+    if path is None:
+        path = data_path()
+    if data_version(path) == data.version:
+        return False
+    # Open the database and the track store before taking the lock, so that
+    # requests do not wait for the load.
+    new = load_data(path)
+    with data_lock:
+        data = new
+        index_page = None
+        for cache in (
+            encoded_track,
+            tile_level,
+            tile_geojson,
+            bundle_file,
+            search_results,
+            trail_track,
+            waypoints_by_type,
+        ):
+            cache.cache_clear()
+        tags.clear_fragments()
+    app.logger.info('switched to data version %s', new.version)
+    return True
+
+
+@app.before_request
+def check_data():
+    global last_reload_check
+    now = time.monotonic()
+    # One request checks for a new version. The others continue with the
+    # current version instead of waiting.
+    if now - last_reload_check >= RELOAD_INTERVAL and reload_lock.acquire(
+        blocking=False
+    ):
+        try:
+            if now - last_reload_check >= RELOAD_INTERVAL:
+                last_reload_check = now
+                reload_data()
+        finally:
+            reload_lock.release()
+    with data_lock:
+        d = flask.g._data = data
+        inflight[d.version] += 1
+
+
+@app.teardown_request
+def release_data(exception):
+    _ = exception
+    d = getattr(flask.g, '_data', None)
+    if d is None:
+        return
+    with data_lock:
+        inflight[d.version] -= 1
+        if inflight[d.version] <= 0:
+            del inflight[d.version]
+            if d.version != data.version:
+                app.logger.info('drained data version %s', d.version)
+
+
 def get_db() -> sqlite3.Connection:
     db = getattr(flask.g, '_database', None)
     if db is None:
-        uri = f'file:{DATA_DIR / "trail.db"}?mode=ro'
-        db = flask.g._database = sqlite3.connect(uri, uri=True)
+        db = flask.g._database = connect(current_data().path)
     return db
 
 
+def use_version(version: str) -> None:
+    # Switch to a data version if it is not the current version. Used by
+    # the render worker processes. Raise VersionGone if the version was
+    # removed, so that other data is not rendered under its key.
+    if version != data.version:
+        reload_data(version_path(version))
+    if data.version != version:
+        raise VersionGone(version)
+
+
 @app.teardown_appcontext
 def close_connection(exception):
     _ = exception
@@ -41,12 +264,6 @@ def close_connection(exception):
         db.close()
 
 
-class Point(typing.NamedTuple):
-    lon: str
-    lat: str
-    ele: str
-
-
 class Waypoint(typing.NamedTuple):
     name: str
     type: str
@@ -54,6 +271,8 @@ class Waypoint(typing.NamedTuple):
     lon: str
     lat: str
     ele: str
+    # Along trail mile.
+    mile: float = 0.0
 
     def style(self) -> str:
         # style for KML
@@ -64,6 +283,8 @@ class Passage(typing.NamedTuple):
     passage: str
     name: str
     fname: str
+    # Along trail mile at the start of the passage.
+    start_mile: float = 0.0
 
     def formatted_name(self) -> str:
         return (
@@ -78,6 +299,7 @@ class Passage(typing.NamedTuple):
             i = int(self.passage)
         except ValueError:
             return 'PA'
+        flagstaff_passage = current_data().flagstaff_passage
         if i == flagstaff_passage:
             return 'PA'
         elif i < flagstaff_passage:
@@ -85,91 +307,102 @@ class Passage(typing.NamedTuple):
         else:
             return 'P1' if i % 2 == 0 else 'P2'
 
-    def track(self) -> abc.Iterator[Point]:
-        with (DATA_DIR / self.fname).open('r') as f:
-            for row in csv.reader(f):
-                yield Point(*row)
+    def track(self) -> trackstore.Track:
+        # Track as lon, lat and ele lists of strings.
+        tracks = current_data().tracks
+        if tracks is not None and self.fname in tracks:
+            return tracks.track(self.fname)
+        with (current_data().path / self.fname).open('r') as f:
+            return trackstore.Track.from_rows(csv.reader(f))
+
+    def coords(self) -> list[tuple[float, float, float]]:
+        # Track as (lon, lat, ele) floats.
+        tracks = current_data().tracks
+        if tracks is not None and self.fname in tracks:
+            return tracks.coords(self.fname)
+        t = self.track()
+        return list(zip(*(map(float, c) for c in (t.lon, t.lat, t.ele))))
 
-    def waypoints(self, allow_types: set[str]) -> abc.Iterator[Waypoint]:
-        if not self.passage:
+    def waypoints(
+        self, waypoint_mask: int, reverse: bool = False
+    ) -> abc.Iterator[Waypoint]:
+        # Waypoints with the types selected by waypoint_mask in the order of
+        # travel.
+        if not self.passage or not waypoint_mask:
             return
 
-        for (
-            type,
-            name,
-            notes,
-            comment,
-            ata_num,
-            lon,
-            lat,
-            ele,
-        ) in get_db().execute(
-            """SELECT type, name, notes, comment, ata_num, lon, lat, ele FROM waypoints
-            WHERE passage = ?""",
-            (self.passage,),
+        for row in get_db().execute(
+            f"""SELECT {waypoint_fields} FROM waypoints
+            WHERE passage = ? AND (? >> type_id) & 1
+            ORDER BY trail_mile {'DESC' if reverse else 'ASC'}""",
+            (self.passage, waypoint_mask),
         ):
-            if not type in allow_types:
-                continue
+            wpt = make_waypoint(*row)
+            if wpt is not None:
+                yield wpt
 
-            # The following is an attempt to filter out waypoints with low
-            # significance (example: junction with unnamed 2 track), and to
-            # create better names and description.
-
-            if type == 'Trailhead':
-                name = name + ' Trailheaad'
-            elif type in ('Road Jct', 'Highway Jct', 'Interstate Jct'):
-                if not name or name == 'RJ':
-                    continue
-                name = f'RJ {name}'
-            elif type == 'Trail Jct':
-                if not name:
-                    continue
-                name = f'TJ {name}'
-            elif type == 'Water':
-                name, _, _ = name.partition('&')
-                name = f'{name} {notes}'.strip()
-            elif type == 'Milepost':
-                name = ata_num
-            elif type == 'Landmark':
-                pass
-            else:
-                name = comment
-
-            if not name:
-                continue
 
-            comment = comment.removeprefix(name)
+waypoint_fields = (
+    'type, name, notes, comment, ata_num, lon, lat, ele, trail_mile'
+)
 
-            yield Waypoint(
-                type=type,
-                name=name,
-                comment=comment,
-                lon=lon,
-                lat=lat,
-                ele=ele,
-            )
 
+def make_waypoint(
+    type, name, notes, comment, ata_num, lon, lat, ele, trail_mile
+) -> Waypoint | None:
+    # The following is an attempt to filter out waypoints with low
+    # significance (example: junction with unnamed 2 track), and to
+    # create better names and description.
 
-@app.route('/download')
-def download():
-    args = flask.request.args
-    allowed_waypoint_types = set(
-        waypoint_types[i]
-        for i in args.getlist('wp', type=int)
-        if i >= 0 and i < len(waypoint_types)
+    if type == 'Trailhead':
+        name = name + ' Trailheaad'
+    elif type in ('Road Jct', 'Highway Jct', 'Interstate Jct'):
+        if not name or name == 'RJ':
+            return None
+        name = f'RJ {name}'
+    elif type == 'Trail Jct':
+        if not name:
+            return None
+        name = f'TJ {name}'
+    elif type == 'Water':
+        name, _, _ = name.partition('&')
+        name = f'{name} {notes}'.strip()
+    elif type == 'Milepost':
+        name = ata_num
+    elif type == 'Landmark':
+        pass
+    else:
+        name = comment
+
+    if not name:
+        return None
+
+    comment = comment.removeprefix(name)
+
+    return Waypoint(
+        type=type,
+        name=name,
+        comment=comment,
+        lon=lon,
+        lat=lat,
+        ele=ele,
+        mile=trail_mile,
     )
 
-    direction = lambda x: x
-    if args.get('dir', default='NOBO') == 'SOBO':
-        direction = lambda x: reversed(list(x))
 
-    fmt_templates = dict(gpx=templates.gpx, kml=templates.kml)
-    fmt = args.get('format', default='gpx')
-    if fmt not in fmt_templates:
-        flask.abort(400, description='Invalid format')
+def selected_waypoint_mask(args) -> int:
+    # Bitmask of the selected waypoint type IDs.
+    waypoint_types = current_data().waypoint_types
+    mask = 0
+    for i in args.getlist('wp', type=int):
+        if i in waypoint_types:
+            mask |= 1 << i
+    return mask
+
 
+def selected_passages(args) -> list[Passage]:
     start = args.get('start', type=int, default=1)
-    if start < 1 or start > max_passage:
+    if start < 1 or start > current_data().max_passage:
         flask.abort(400, description='Invalid passsage')
 
     end = args.get('end', type=int, default=0)
@@ -178,53 +411,685 @@ def download():
     elif end < start:
         end = start
 
-    passages = [
-        Passage(passage=passage, name=name, fname=fname)
-        for passage, name, fname in get_db().execute(
-            """SELECT passage, name, fname FROM passages
-           WHERE
-                passage GLOB '[0-9][0-9]'
-                AND CAST(passage as INTEGER) >= ?
-                AND CAST(passage as INTEGER) <= ?
-           ORDER BY passage
-           """,
+    return [
+        Passage(passage=passage, name=name, fname=fname, start_mile=mile)
+        for passage, name, fname, mile in get_db().execute(
+            """SELECT passage, name, fname, start_mile FROM passages
+               WHERE num BETWEEN ? AND ?
+               ORDER BY num""",
             (start, end),
         )
     ]
 
-    if len(passages) > max_passage:
+
+fmt_templates = dict(gpx=templates.gpx, kml=templates.kml, fit=fit.course)
+fmt_mimetypes = dict(
+    gpx='text/xml', kml='text/xml', fit='application/vnd.ant.fit'
+)
+# Formats written as bytes. Other formats are written as str.
+binary_formats = {'fit'}
+
+# Hash of the source of the modules that render downloads. The download key
+# includes it so that a cache kept across a deployment does not serve output
+# rendered by different code, with or without App Engine.
+render_code_version = hashlib.sha1(
+    b''.join(
+        pathlib.Path(m.__file__).read_bytes()
+        for m in (blockgzip, fit, tags, templates, trackstore)
+    )
+    + pathlib.Path(__file__).read_bytes()
+).hexdigest()[:16]
+
+
+class Download(typing.NamedTuple):
+    # Normalized options for a download. Equal downloads have equal output.
+    fmt: str
+    name: str
+    passages: tuple[Passage, ...]
+    # Bitmask of selected waypoint type IDs.
+    waypoint_mask: int
+    reverse: bool
+    # Maximum number of points in a track. Zero means no limit.
+    max_points: int = 0
+    # Data version.
+    version: str = ''
+    # Render the passages as a single track.
+    merge: bool = False
+    # Add a waypoint at the start of each passage in a single track.
+    boundaries: bool = False
+
+    def filename(self) -> str:
+        passages = self.passages
+        if len(passages) > current_data().max_passage:
+            stem = 'azt'
+        elif len(passages) == 1:
+            stem = f'passage-{passages[0].passage}'
+        else:
+            stem = f'passage-{passages[0].passage}-{passages[-1].passage}'
+        return f'{stem}.{self.fmt}'
+
+    def key(self) -> str:
+        # Key for the output in the download cache. The App Engine version
+        # and the render code version are included so that a deployment
+        # does not use output rendered by different code. The key is also
+        # the strong ETag, so it includes the compression settings that
+        # change the output bytes.
+        return json.dumps(
+            [
+                os.environ.get('GAE_VERSION', ''),
+                render_code_version,
+                blockgzip.BLOCK_SIZE,
+                blockgzip.LEVEL,
+                self.version,
+                self.fmt,
+                self.name,
+                [p.passage for p in self.passages],
+                self.waypoint_mask,
+                self.reverse,
+                self.max_points,
+                self.merge,
+                self.boundaries,
+            ]
+        )
+
+
+def render_template(
+    write: abc.Callable[[typing.Any], typing.Any], dl: Download
+) -> None:
+    fmt_templates[dl.fmt](
+        write,
+        name=dl.name,
+        passages=dl.passages,
+        waypoint_mask=dl.waypoint_mask,
+        reverse=dl.reverse,
+        max_points=dl.max_points,
+        merge=dl.merge,
+        boundaries=dl.boundaries,
+    )
+
+
+def write_download(f: typing.BinaryIO, dl: Download) -> None:
+    # Render a download to the binary file f. Text formats are encoded as
+    # UTF-8.
+    if dl.fmt in binary_formats:
+        render_template(f.write, dl)
+    else:
+        w = io.TextIOWrapper(f, encoding='utf-8')
+        render_template(w.write, dl)
+        w.flush()
+        w.detach()
+
+
+def render_download(dl: Download) -> bytes:
+    # Render a download and return the gzip compressed output. Large
+    # outputs are compressed in parallel blocks. Equal downloads have equal
+    # bytes.
+    out = io.BytesIO()
+    gz = blockgzip.Writer(out.write)
+    write_download(gz, dl)
+    gz.close()
+    return out.getvalue()
+
+
+def render_body(dl: Download) -> bytes:
+    if render.use_process(dl.passages):
+        body = render.submit(dl)
+    else:
+        body = render_download(dl)
+    if download_cache is not None:
+        download_cache.put(dl.key(), body)
+    return body
+
+
+render_group = singleflight.Group()
+
+download_cache = (
+    filecache.Cache(pathlib.Path(DOWNLOAD_CACHE_DIR), DOWNLOAD_CACHE_BYTES)
+    if DOWNLOAD_CACHE_DIR
+    else None
+)
+
+
+def selected_download(args) -> Download:
+    fmt = args.get('format', default='gpx')
+    if fmt not in fmt_templates:
+        flask.abort(400, description='Invalid format')
+
+    max_points = args.get('max_points', type=int, default=0)
+    if max_points < 0 or max_points == 1:
+        flask.abort(400, description='Invalid max_points')
+
+    passages = selected_passages(args)
+
+    if len(passages) > current_data().max_passage:
         name = 'AZT'
-        stem = 'azt'
     elif len(passages) == 1:
         name = f'AZT {passages[0].formatted_name()}'
-        stem = f'passage-{passages[0].passage}'
     else:
         name = f'AZT Passages {passages[0].passage} - {passages[-1].passage}'
-        stem = f'passage-{passages[0].passage}-{passages[-1].passage}'
 
-    out = io.BytesIO()
-    gz = gzip.open(out, encoding='utf-8', mode='wt')
-    fmt_templates[fmt](
-        gz.write,
+    return Download(
+        fmt=fmt,
         name=name,
-        passages=passages,
-        allowed_waypoint_types=allowed_waypoint_types,
-        direction=direction,
+        passages=tuple(passages),
+        waypoint_mask=selected_waypoint_mask(args),
+        reverse=args.get('dir', default='NOBO') == 'SOBO',
+        max_points=max_points,
+        version=current_data().version,
+        merge=args.get('merge', type=int, default=0) != 0,
+        boundaries=args.get('boundaries', type=int, default=0) != 0,
     )
-    gz.close()
+
+
+def download_log_fields(dl: Download) -> dict:
+    # Normalized parameters of a download for the access log.
+    fields = dict(
+        format=dl.fmt,
+        passages=[p.passage for p in dl.passages],
+        waypoint_mask=dl.waypoint_mask,
+        reverse=dl.reverse,
+        max_points=dl.max_points,
+        version=dl.version,
+        merge=dl.merge,
+        boundaries=dl.boundaries,
+    )
+    tracks = current_data().tracks
+    if tracks is not None:
+        # Track points before simplification to max_points.
+        fields['points'] = sum(
+            tracks.points(p.fname) for p in dl.passages if p.fname in tracks
+        )
+    return fields
+
+
+@app.route('/download')
+def download():
+    dl = selected_download(flask.request.args)
+
+    headers = {
+        'Content-Disposition': f'attachment; filename="{dl.filename()}"',
+        'Content-Encoding': 'gzip',
+    }
+
+    # Output is determined by the key, so the ETag is known before the
+    # download is rendered. It is a strong validator for Range requests.
+    if accesslog.enabled():
+        accesslog.add(**download_log_fields(dl))
+
+    key = dl.key()
+    etag = hashlib.sha1(key.encode()).hexdigest()[:16]
+    if etag in flask.request.if_none_match:
+        accesslog.add(cache='not_modified')
+        resp = flask.Response(status=304, headers=headers)
+        resp.set_etag(etag)
+        return resp
+
+    resp = None
+    if download_cache is not None:
+        f = download_cache.get(key)
+        if f is not None:
+            # The server's file wrapper sends the file with sendfile where
+            # available.
+            size = os.fstat(f.fileno()).st_size
+            resp = flask.Response(
+                werkzeug.wsgi.wrap_file(flask.request.environ, f),
+                mimetype=fmt_mimetypes[dl.fmt],
+                headers=headers,
+                direct_passthrough=True,
+            )
+            resp.content_length = size
+            accesslog.add(cache='disk', gzip_bytes=size)
+
+    if resp is None:
+        # Identical concurrent downloads share a single render.
+        try:
+            with accesslog.phase('render'):
+                body, shared = render_group.do(dl, render_body, dl)
+        except render.Busy:
+            accesslog.add(cache='busy')
+            flask.abort(
+                503,
+                description='Too many large downloads in progress',
+                retry_after=render.RETRY_AFTER,
+            )
+        except VersionGone:
+            # The data was updated while the download waited. A retry
+            # renders the current version.
+            accesslog.add(cache='version_gone')
+            flask.abort(
+                503,
+                description='The data was updated, try again',
+                retry_after=1,
+            )
+        size = len(body)
+        accesslog.add(
+            cache='shared' if shared else 'render',
+            gzip_bytes=size,
+            # The gzip trailer ends with the uncompressed size modulo 2**32.
+            raw_bytes=int.from_bytes(body[-4:], 'little'),
+        )
+        resp = flask.Response(
+            body, mimetype=fmt_mimetypes[dl.fmt], headers=headers
+        )
+
+    resp.set_etag(etag)
+    return resp.make_conditional(
+        flask.request, accept_ranges=True, complete_length=size
+    )
+
+
+@functools.lru_cache(maxsize=256)
+def bundle_file(dl: Download) -> zipstream.File:
+    # Compressed file for a single passage download in a bundle.
+    out = io.BytesIO() if dl.fmt in binary_formats else io.StringIO()
+    render_template(out.write, dl)
+    b = out.getvalue()
+    return zipstream.compress(b if isinstance(b, bytes) else b.encode())
+
+
+@app.route('/bundle')
+def bundle():
+    dl = selected_download(flask.request.args)
+    passages = dl.passages
+    stem = f'passages-{passages[0].passage}-{passages[-1].passage}-{dl.fmt}'
+    if dl.reverse:
+        passages = passages[::-1]
+
+    def generate():
+        w = zipstream.Writer()
+        for passage in passages:
+            f = bundle_file(
+                dl._replace(
+                    name=f'AZT {passage.formatted_name()}',
+                    passages=(passage,),
+                )
+            )
+            mtime = (current_data().path / passage.fname).stat().st_mtime
+            yield w.file(f'passage-{passage.passage}.{dl.fmt}', f, mtime)
+        yield w.close()
 
     return flask.Response(
-        out.getvalue(),
-        mimetype='text/xml',
+        flask.stream_with_context(generate()),
+        mimetype='application/zip',
         headers={
-            'Content-Disposition': f'attachment; filename="{stem}.{fmt}"',
-            'Content-Encoding': 'gzip',
+            'Content-Disposition': f'attachment; filename="{stem}.zip"',
         },
     )
 
 
-@app.route('/')
-def root():
+@app.route('/stats')
+def stats():
+    return flask.jsonify(
+        renders=render_group.calls,
+        coalesced_renders=render_group.coalesced,
+    )
+
+
+@functools.lru_cache(maxsize=256)
+def encoded_track(
+    version: str, fname: str, precision: int, reverse: bool
+) -> tuple[str, str]:
+    # Encoded (lat, lon) polyline and parallel elevation series (decimeter
+    # precision) for a passage track.
+    points = Passage(passage='', name='', fname=fname).coords()
+    if reverse:
+        points.reverse()
+    return (
+        polyline.encode(((lat, lon) for lon, lat, _ in points), precision),
+        polyline.encode(((ele,) for _, _, ele in points), 1),
+    )
+
+
+@app.route('/polyline')
+def polyline_json():
+    args = flask.request.args
+    waypoint_mask = selected_waypoint_mask(args)
+    precision = args.get('precision', type=int, default=5)
+    if precision < 0 or precision > 7:
+        flask.abort(400, description='Invalid precision')
+    reverse = args.get('dir', default='NOBO') == 'SOBO'
+    include_ele = args.get('ele', type=int, default=0) != 0
+
+    passages = selected_passages(args)
+    if reverse:
+        passages.reverse()
+
+    result = []
+    for passage in passages:
+        line, ele = encoded_track(
+            current_data().version, passage.fname, precision, reverse
+        )
+        track = dict(
+            passage=passage.passage,
+            name=passage.formatted_name(),
+            style=passage.style(),
+            polyline=line,
+        )
+        if include_ele:
+            track['elevation'] = ele
+        track['waypoints'] = [
+            dict(
+                name=p.name,
+                type=p.type,
+                comment=p.comment,
+                lat=p.lat,
+                lon=p.lon,
+                ele=p.ele,
+                mile=round(p.mile, 2),
+            )
+            for p in passage.waypoints(waypoint_mask, reverse)
+        ]
+        result.append(track)
+
+    return flask.jsonify(precision=precision, passages=result)
+
+
+@functools.lru_cache(maxsize=32)
+def tile_level(
+    version: str,
+    zoom: int,
+) -> list[tuple[Passage, tiles.BBox, list[tuple[float, float]]]]:
+    # Track geometry for all passages at zoom.
+    result = []
+    if zoom > tiles.MAX_ZOOM:
+        for passage, name, fname in get_db().execute(
+            'SELECT passage, name, fname FROM passages'
+        ):
+            p = Passage(passage=passage, name=name, fname=fname)
+            points = [(lon, lat) for lon, lat, _ in p.coords()]
+            result.append((p, tiles.line_bbox(points), points))
+    else:
+        for passage, name, fname, coords in get_db().execute(
+            """SELECT p.passage, p.name, p.fname, s.coords
+               FROM simplified s JOIN passages p ON p.fname = s.fname
+               WHERE s.zoom = ?""",
+            (zoom,),
+        ):
+            p = Passage(passage=passage, name=name, fname=fname)
+            points = [(lon, lat) for lon, lat in json.loads(coords)]
+            result.append((p, tiles.line_bbox(points), points))
+    return result
+
+
+@functools.lru_cache(maxsize=1024)
+def tile_geojson(version: str, z: int, x: int, y: int) -> bytes:
+    bbox = tiles.tile_bbox(z, x, y)
+    # Include a margin so that lines and points near the edge are not cut.
+    margin = bbox.expand((bbox.east - bbox.west) / 64)
+    n = tiles.digits(z)
+    features = []
+    for passage, line_bbox, points in tile_level(
+        version, min(z, tiles.MAX_ZOOM + 1)
+    ):
+        if not line_bbox.intersects(margin):
+            continue
+        for part in tiles.clip(points, margin):
+            features.append(
+                dict(
+                    type='Feature',
+                    geometry=dict(
+                        type='LineString',
+                        coordinates=[
+                            [round(lon, n), round(lat, n)] for lon, lat in part
+                        ],
+                    ),
+                    properties=dict(
+                        passage=passage.passage,
+                        name=passage.formatted_name(),
+                        style=passage.style(),
+                    ),
+                )
+            )
+    if z >= tiles.WAYPOINT_MIN_ZOOM:
+        for row in get_db().execute(
+            f"""SELECT {waypoint_fields} FROM waypoints
+                WHERE lon BETWEEN ? AND ? AND lat BETWEEN ? AND ?""",
+            (margin.west, margin.east, margin.south, margin.north),
+        ):
+            wpt = make_waypoint(*row)
+            if wpt is None:
+                continue
+            features.append(
+                dict(
+                    type='Feature',
+                    geometry=dict(
+                        type='Point',
+                        coordinates=[round(wpt.lon, n), round(wpt.lat, n)],
+                    ),
+                    properties=dict(
+                        name=wpt.name,
+                        type=wpt.type,
+                        comment=wpt.comment,
+                        mile=round(wpt.mile, 2),
+                    ),
+                )
+            )
+    return json.dumps(
+        dict(type='FeatureCollection', features=features),
+        separators=(',', ':'),
+    ).encode('utf-8')
+
+
+@app.route('/tiles/<int:z>/<int:x>/<int:y>')
+def tile(z: int, x: int, y: int):
+    if z > 22 or x >= 2**z or y >= 2**z:
+        flask.abort(404)
+    return flask.Response(
+        tile_geojson(current_data().version, z, x, y),
+        mimetype='application/geo+json',
+    )
+
+
+# Maximum number of search results.
+MAX_SEARCH_RESULTS = 50
+
+
+def search_match(q: str) -> str:
+    # FTS5 query for the words in q. Each word is quoted so that it is not
+    # read as query syntax, and matches as a prefix so that results are
+    # returned as the user types.
+    words = re.findall(r'\w+', q)[:8]
+    return ' '.join(f'"{w}"*' for w in words)
+
+
+@functools.lru_cache(maxsize=4096)
+def search_results(version: str, match: str, limit: int) -> bytes:
+    _ = version
+    default_ids = [
+        i
+        for i, name in current_data().waypoint_types.items()
+        if name in default_checked_waypoint_types
+    ]
+    max_passage = current_data().max_passage
+    results = []
+    # Fetch twice the limit, since make_waypoint drops some rows, and fetch
+    # more if that is not enough. Names are weighted over notes and notes
+    # over comments.
+    batch = 2 * limit
+    offset = 0
+    while len(results) < limit:
+        rows = (
+            get_db()
+            .execute(
+                f"""SELECT {waypoint_fields}, passage, type_id
+                FROM waypoint_search
+                WHERE waypoint_search MATCH ?
+                ORDER BY bm25(waypoint_search, 10.0, 2.0, 1.0)
+                LIMIT ? OFFSET ?""",
+                (match, batch, offset),
+            )
+            .fetchall()
+        )
+        for *row, passage, type_id in rows:
+            wpt = make_waypoint(*row)
+            if wpt is None:
+                continue
+            result = dict(
+                name=wpt.name,
+                type=wpt.type,
+                comment=wpt.comment,
+                lat=wpt.lat,
+                lon=wpt.lon,
+                passage=passage,
+                mile=round(wpt.mile, 2),
+            )
+            if passage.isdigit() and 1 <= int(passage) <= max_passage:
+                # Download of the passage with the default waypoint types
+                # and the type of the result.
+                result['download'] = flask.url_for(
+                    'download',
+                    start=int(passage),
+                    wp=sorted({*default_ids, type_id}),
+                )
+            results.append(result)
+            if len(results) >= limit:
+                break
+        if len(rows) < batch:
+            break
+        offset += batch
+    return json.dumps(dict(results=results), separators=(',', ':')).encode(
+        'utf-8'
+    )
+
+
+@app.route('/search')
+def search():
+    args = flask.request.args
+    limit = args.get('limit', type=int, default=10)
+    if limit < 1 or limit > MAX_SEARCH_RESULTS:
+        flask.abort(400, description='Invalid limit')
+    match = search_match(args.get('q', default='')[:200])
+    if not match:
+        body = b'{"results":[]}'
+    else:
+        body = search_results(current_data().version, match, limit)
+    return flask.Response(body, mimetype='application/json')
+
+
+@functools.lru_cache(maxsize=1)
+def trail_track(version: str) -> geo.Track:
+    # The numbered passages from the southern terminus with the grid index
+    # of the segments. This is the track build.py uses for trail miles.
+    _ = version
+    points = []
+    for (fname,) in get_db().execute("""SELECT fname FROM passages
+           WHERE num IS NOT NULL
+           ORDER BY num"""):
+        points.extend(
+            (lon, lat)
+            for lon, lat, _ in Passage(
+                passage='', name='', fname=fname
+            ).coords()
+        )
+    return geo.Track(points)
+
+
+class TypeWaypoints(typing.NamedTuple):
+    # Waypoints of a type in trail order.
+    miles: list[float]
+    # (waypoint, passage) for each mile.
+    waypoints: list[tuple[Waypoint, str]]
+
+
+@functools.lru_cache(maxsize=1)
+def waypoints_by_type(version: str) -> dict[int, TypeWaypoints]:
+    _ = version
+    result: dict[int, TypeWaypoints] = {}
+    for *row, passage, type_id in get_db().execute(
+        f"""SELECT {waypoint_fields}, passage, type_id FROM waypoints
+            ORDER BY trail_mile"""
+    ):
+        wpt = make_waypoint(*row)
+        if wpt is None:
+            continue
+        tw = result.setdefault(type_id, TypeWaypoints([], []))
+        tw.miles.append(wpt.mile)
+        tw.waypoints.append((wpt, passage))
+    return result
+
+
+# Maximum number of waypoints returned by /ahead.
+MAX_AHEAD = 100
+
+
+@app.route('/ahead')
+def ahead():
+    # The next waypoints of the selected types from a trail mile or a
+    # position in the direction of travel.
+    args = flask.request.args
+    version = current_data().version
+    reverse = args.get('dir', default='NOBO') == 'SOBO'
+    n = args.get('n', type=int, default=5)
+    if n < 1 or n > MAX_AHEAD:
+        flask.abort(400, description='Invalid n')
+    mask = selected_waypoint_mask(args)
+    if 'wp' not in args:
+        for i, name in current_data().waypoint_types.items():
+            if name in default_checked_waypoint_types:
+                mask |= 1 << i
+
+    result: dict[str, typing.Any] = {}
+    if 'lon' in args or 'lat' in args:
+        lon = args.get('lon', type=float)
+        lat = args.get('lat', type=float)
+        if (
+            lon is None
+            or lat is None
+            or not -180 <= lon <= 180
+            or not -90 <= lat <= 90
+        ):
+            flask.abort(400, description='Invalid position')
+        mile, off_trail = trail_track(version).nearest(lon, lat)
+        result['off_trail'] = round(off_trail, 2)
+    else:
+        mile = args.get('mile', type=float)
+        if mile is None or not math.isfinite(mile):
+            flask.abort(400, description='Invalid mile')
+
+    # Up to n waypoints of each type from a binary search of the miles of
+    # the type, then the n nearest of those.
+    candidates = []
+    for type_id, tw in waypoints_by_type(version).items():
+        if not (mask >> type_id) & 1:
+            continue
+        if reverse:
+            i = bisect.bisect_right(tw.miles, mile)
+            candidates.extend(reversed(tw.waypoints[max(0, i - n) : i]))
+        else:
+            i = bisect.bisect_left(tw.miles, mile)
+            candidates.extend(tw.waypoints[i : i + n])
+    candidates.sort(key=lambda c: abs(c[0].mile - mile))
+
+    result['mile'] = round(mile, 2)
+    result['waypoints'] = [
+        dict(
+            name=wpt.name,
+            type=wpt.type,
+            comment=wpt.comment,
+            lat=wpt.lat,
+            lon=wpt.lon,
+            ele=wpt.ele,
+            passage=passage,
+            mile=round(wpt.mile, 2),
+            distance=round(abs(wpt.mile - mile), 2),
+        )
+        for wpt, passage in candidates[:n]
+    ]
+    return flask.jsonify(result)
+
+
+class Page(typing.NamedTuple):
+    version: str
+    body: bytes
+    gzip_body: bytes
+    etag: str
+
+
+# Rendered index page for the current data version.
+index_page: Page | None = None
+
+
+def render_index() -> bytes:
     # index, name, checked
     waypoints = [
         (
@@ -232,43 +1097,41 @@ def root():
             name,
             name in default_checked_waypoint_types,
         )
-        for i, name in enumerate(waypoint_types)
+        for i, name in current_data().waypoint_types.items()
     ]
     passages = [
         Passage(passage=passage, name=name, fname='')
         for passage, name in get_db().execute(
             """SELECT passage, name FROM passages
-               WHERE passage GLOB '[0-9][0-9]'
-               ORDER BY passage"""
+               WHERE num IS NOT NULL
+               ORDER BY num"""
         )
     ]
     out = io.StringIO()
     templates.index(out.write, passages, waypoints)
-    return out.getvalue()
+    return out.getvalue().encode('utf-8')
 
 
-with app.app_context():
-    waypoint_types: list[str] = [
-        r[0]
-        for r in get_db().execute(
-            'SELECT DISTINCT type FROM waypoints ORDER BY type'
-        )
-    ]
-    flagstaff_passage = (
-        get_db()
-        .execute(
-            """SELECT CAST(passage as integer) FROM passages
-               WHERE name = 'Flagstaff'"""
+@app.route('/')
+def root():
+    global index_page
+    version = current_data().version
+    page = index_page
+    if page is None or page.version != version:
+        body = render_index()
+        page = index_page = Page(
+            version=version,
+            body=body,
+            gzip_body=gzip.compress(body, mtime=0),
+            etag=hashlib.sha1(body).hexdigest()[:16],
         )
-        .fetchone()[0]
-    )
-    max_passage = (
-        get_db()
-        .execute("""SELECT MAX(CAST(passage as integer)) FROM passages""")
-        .fetchone()[0]
-    )
-
-if __name__ == '__main__':
-    # Flask's development server automatically serves static files from /static.
-    app.run(host='127.0.0.1', port=8080, debug=True)
 
+    if flask.request.accept_encodings['gzip']:
+        resp = flask.Response(page.gzip_body, mimetype='text/html')
+        resp.headers['Content-Encoding'] = 'gzip'
+        resp.set_etag(f'{page.etag}-gz')
+    else:
+        resp = flask.Response(page.body, mimetype='text/html')
+        resp.set_etag(page.etag)
+    resp.vary.add('Accept-Encoding')
+    return resp.make_conditional(flask.request)
@@ -0,0 +1,31 @@
+# Encoded polyline format used by web map clients.
+#
+# See
+# https://developers.google.com/maps/documentation/utilities/polylinealgorithm
+
+from collections import abc
+
+
+def _encode_value(v: int, out: list[str]) -> None:
+    v = ~(v << 1) if v < 0 else v << 1
+    while v >= 0x20:
+        out.append(chr((0x20 | (v & 0x1F)) + 63))
+        v >>= 5
+    out.append(chr(v + 63))
+
+
+def encode(rows: abc.Iterable[abc.Sequence[float]], precision: int = 5) -> str:
+    # Encode rows of values as a polyline. Each row is a tuple of values (lat,
+    # lon for a standard polyline, or a single value for a parallel series such
+    # as elevation). Consecutive rows are delta encoded column by column.
+    factor = 10**precision
+    out: list[str] = []
+    prev: list[int] = []
+    for row in rows:
+        if not prev:
+            prev = [0] * len(row)
+        for i, v in enumerate(row):
+            n = round(v * factor)
+            _encode_value(n - prev[i], out)
+            prev[i] = n
+    return ''.join(out)
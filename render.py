@@ -0,0 +1,114 @@
+# Rendering of large downloads in worker processes.
+#
+# Rendering is pure Python, so concurrent large downloads rendered in server
+# threads serialize on the GIL. Downloads with at least PROCESS_PASSAGES
+# passages are rendered in a pool of worker processes. Workers read the
+# tracks from the files of the download's data version and share the
+# packed tracks in trackstore.py with the server. When QUEUE_LIMIT
+# downloads are already waiting on the pool, submit() raises Busy and the
+# server responds with 503. A pool with a dead worker is replaced.
+
+import concurrent.futures
+import concurrent.futures.process
+import logging
+import multiprocessing
+import os
+import threading
+
+# Minimum number of passages for rendering in a worker process. Zero
+# disables the pool.
+PROCESS_PASSAGES = int(os.environ.get('RENDER_PROCESS_PASSAGES', '8'))
+
+PROCESSES = int(os.environ.get('RENDER_PROCESSES', os.cpu_count() or 1))
+
+# Maximum number of downloads submitted to the pool and not yet complete.
+QUEUE_LIMIT = int(os.environ.get('RENDER_QUEUE_LIMIT', 2 * PROCESSES))
+
+# Seconds for the Retry-After header when the pool is busy.
+RETRY_AFTER = 5
+
+
+_log = logging.getLogger(__name__)
+
+
+class Busy(Exception):
+    pass
+
+
+_lock = threading.Lock()
+_pool: concurrent.futures.ProcessPoolExecutor | None = None
+_pending = 0
+
+
+def use_process(passages) -> bool:
+    return PROCESS_PASSAGES > 0 and len(passages) >= PROCESS_PASSAGES
+
+
+def _init() -> None:
+    # Workers compress in one thread. The pool of processes already uses
+    # the CPUs, and a gzip pool per worker would oversubscribe them.
+    import blockgzip
+
+    blockgzip.THREADS = 1
+
+    # Import the application when the worker starts instead of on the first
+    # download.
+    import main
+
+    _ = main
+
+
+def _render(dl) -> bytes:
+    import main
+
+    # The data may have been reloaded since the worker started.
+    main.use_version(dl.version)
+    with main.app.app_context():
+        return main.render_download(dl)
+
+
+def _get_pool() -> concurrent.futures.ProcessPoolExecutor:
+    global _pool
+    with _lock:
+        if _pool is None:
+            # Use spawn because fork is not safe in a threaded server.
+            _pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=PROCESSES,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init,
+            )
+        return _pool
+
+
+def _drop_pool(pool: concurrent.futures.ProcessPoolExecutor) -> None:
+    # Replace a broken pool on the next call. Another thread may have
+    # replaced it already.
+    global _pool
+    with _lock:
+        if _pool is not pool:
+            return
+        _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def submit(dl) -> bytes:
+    # Render main.render_download(dl) in a worker process. If a worker dies,
+    # the pool is replaced and the download is retried once. Busy is raised if
+    # the retry also fails.
+    global _pending
+    with _lock:
+        if _pending >= QUEUE_LIMIT:
+            raise Busy()
+        _pending += 1
+    try:
+        for attempt in range(2):
+            pool = _get_pool()
+            try:
+                return pool.submit(_render, dl).result()
+            except concurrent.futures.process.BrokenProcessPool:
+                _log.warning('render pool broken (attempt %d)', attempt + 1)
+                _drop_pool(pool)
+        raise Busy()
+    finally:
+        with _lock:
+            _pending -= 1
@@ -0,0 +1,49 @@
+# Duplicate call suppression.
+#
+# Concurrent calls to Group.do() with the same key share the result of a
+# single call to the function. This is a port of Go's singleflight package.
+
+import concurrent.futures
+import threading
+import typing
+
+
+class Group:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: dict[typing.Any, concurrent.futures.Future] = {}
+        # Number of calls to the function.
+        self.calls = 0
+        # Number of callers that waited on a call in progress.
+        self.coalesced = 0
+
+    def do(
+        self,
+        key: typing.Any,
+        fn: typing.Callable[..., typing.Any],
+        *args: typing.Any
+    ) -> tuple[typing.Any, bool]:
+        # Call fn(*args) unless a call with key is in progress. Return the
+        # result and whether the result was shared with another caller.
+        # Exceptions raised by fn are raised in all callers.
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                self.calls += 1
+                future = self._calls[key] = concurrent.futures.Future()
+            else:
+                self.coalesced += 1
+        if not leader:
+            return future.result(), True
+        try:
+            result = fn(*args)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            with self._lock:
+                del self._calls[key]
+        return result, False
@@ -1,3 +1,4 @@
+import functools
 import typing
 import re
 from typing import Any
@@ -707,3 +708,42 @@ class XDocument:
         self._ctx = ctx
         return ctx
 
+
+# Memoized rendering functions, for clear_fragments().
+_fragments: list[Any] = []
+
+
+def fragment(maxsize: int | None = 128):
+    # Decorator to memoize the output of a rendering function. The decorated
+    # function is called as fn(d, *args) where d is a Document or XDocument.
+    # The output for each document type and arguments is rendered once to a
+    # string and printed raw to d on later calls. The arguments must be
+    # hashable. Call cache_clear() on the decorated function or
+    # clear_fragments() to discard the rendered output.
+
+    def decorator(fn):
+        @functools.lru_cache(maxsize=maxsize)
+        def render(doc_type, *args) -> str:
+            parts: list[str] = []
+            d = doc_type(parts.append)
+            fn(d, *args)
+            if d._ctx:
+                d._ctx._close()
+            return ''.join(parts)
+
+        @functools.wraps(fn)
+        def wrapper(d, *args) -> None:
+            d.printr(render(type(d), *args))
+
+        wrapper.cache_clear = render.cache_clear
+        wrapper.cache_info = render.cache_info
+        _fragments.append(wrapper)
+        return wrapper
+
+    return decorator
+
+
+def clear_fragments() -> None:
+    # Discard the output of all memoized rendering functions.
+    for f in _fragments:
+        f.cache_clear()
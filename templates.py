@@ -1,4 +1,5 @@
 import tags
+import typing
 
 script = """
 (function() {
@@ -18,6 +19,97 @@ script = """
 """
 
 
+def ordered(items, reverse):
+    # Items in the direction of travel. Tracks are stored northbound.
+    return reversed(list(items)) if reverse else items
+
+
+def ordered_track(passage, reverse):
+    # Track of a passage in the direction of travel.
+    track = passage.track()
+    return track.reversed() if reverse else track
+
+
+def track_parts(name, tracks, max_points):
+    # Split the points of an iterable of tracks into parts with at most
+    # max_points points, counting the points as the tracks are read. Each
+    # part is an iterable of tracks. Each part after the first starts with
+    # the last point of the previous part. The parts are named "name (n)"
+    # when the points are split. Zero max_points means no limit.
+    if max_points <= 0:
+        yield name, tracks
+        return
+    part = []
+    size = 0
+    n = 1
+    for track in tracks:
+        start = 0
+        while start < len(track):
+            if size == max_points:
+                # The part is full and more points follow.
+                yield f'{name} ({n})', part
+                last = part[-1]
+                part = [last[len(last) - 1 :]]
+                size = 1
+                n += 1
+            end = start + max_points - size
+            part.append(track[start:end])
+            size += len(part[-1])
+            start = end
+    yield f'{name} ({n})' if n > 1 else name, part
+
+
+def write_tracks(d, tracks, fmt):
+    for track in tracks:
+        track.write(d.printr, fmt)
+
+
+# Point formats for Track.write.
+gpx_point = "<trkpt lat='{1}' lon='{0}'><ele>{2}</ele></trkpt>"
+kml_point = '{0},{1},{2}\n'
+
+
+class Boundary(typing.NamedTuple):
+    # Waypoint at the start of a passage in a merged track.
+    name: str
+    lon: str
+    lat: str
+    ele: str
+    comment: str = ''
+
+    def style(self) -> str:
+        # style for KML
+        return 'Other'
+
+
+def merged_track(passages, reverse, boundaries):
+    # Generate the tracks of the passages in the direction of travel as the
+    # pieces of one track. The point shared by adjacent passages is included
+    # once. The first point of each passage after the first is stored in
+    # boundaries by passage as the tracks are generated.
+    last = None
+    for passage in ordered(passages, reverse):
+        track = ordered_track(passage, reverse)
+        if not len(track):
+            continue
+        lon, lat, ele = track.point(0)
+        if last is not None:
+            boundaries[passage.passage] = Boundary(
+                f'Passage {passage.formatted_name()}', lon, lat, ele
+            )
+            if (lon, lat) == last[:2]:
+                track = track[1:]
+        if len(track):
+            last = track.point(len(track) - 1)
+            yield track
+
+
+@tags.fragment(maxsize=4)
+def passage_options(d, passages) -> None:
+    for passage in passages:
+        d.OPTION(value=passage.passage)(passage.formatted_name())
+
+
 def index(write, passages, waypoints) -> None:
     d = tags.Document(write)
     d.printr('<!doctype html>')
@@ -43,10 +135,7 @@ def index(write, passages, waypoints) -> None:
                 with d.FORM(id='download', action='/download', method='get'):
                     d.LABEL(for_='start')('Start Passage: ')
                     with d.SELECT(name='start', id='start'):
-                        for passage in passages:
-                            d.OPTION(value=passage.passage)(
-                                passage.formatted_name()
-                            )
+                        passage_options(d, tuple(passages))
                     d.BR()
                     d.LABEL(for_='end')('End Passage: ')
                     with d.SELECT(name='end', id='end'):
@@ -55,10 +144,7 @@ def index(write, passages, waypoints) -> None:
                         d.OPTION(value=-2)('Start + 2')
                         d.OPTION(value=-1)('Start + 1')
                         d.OPTION(selected=True, value=0)('Same as start')
-                        for passage in passages:
-                            d.OPTION(value=passage.passage)(
-                                passage.formatted_name()
-                            )
+                        passage_options(d, tuple(passages))
                     d.BR()
                     with d.FIELDSET():
                         d.LEGEND()('Direction')
@@ -94,6 +180,32 @@ def index(write, passages, waypoints) -> None:
                             value='kml',
                         )
                         d.LABEL(for_='formatkml')('KML')
+                        d.INPUT(
+                            type='radio',
+                            id='formatfit',
+                            name='format',
+                            value='fit',
+                        )
+                        d.LABEL(for_='formatfit')('FIT course')
+                    d.LABEL(for_='max_points')('Max points per track: ')
+                    d.INPUT(
+                        type='number',
+                        id='max_points',
+                        name='max_points',
+                        min=0,
+                        placeholder='No limit',
+                    )
+                    d.BR()
+                    d.INPUT(type='checkbox', id='merge', name='merge', value=1)
+                    d.LABEL(for_='merge')('Single track')
+                    d.INPUT(
+                        type='checkbox',
+                        id='boundaries',
+                        name='boundaries',
+                        value=1,
+                    )
+                    d.LABEL(for_='boundaries')('Mark passage boundaries')
+                    d.BR()
                     with d.FIELDSET():
                         d.LEGEND()('Waypoints')
                         for index, name, checked in waypoints:
@@ -113,29 +225,61 @@ def index(write, passages, waypoints) -> None:
                 d.printr(script)
 
 
-def gpx(write, name, passages, allowed_waypoint_types, direction) -> None:
-    _ = name
+def gpx(
+    write,
+    name,
+    passages,
+    waypoint_mask,
+    reverse,
+    max_points=0,
+    merge=False,
+    boundaries=False,
+) -> None:
     d = tags.XDocument(write)
     d.printr('<?xml version="1.0" encoding="UTF-8"?>')
     with d.tag(
         'gpx', xmlns='http://www.topografix.com/GPX/1/1', version='1.1'
     ):
-        for passage in direction(passages):
-            with d.tag('trk'):
-                d.tag('name')(passage.formatted_name())
-                with d.tag('trkseg'):
-                    for p in direction(passage.track()):
-                        with d.tag('trkpt', lat=p.lat, lon=p.lon):
-                            d.tag('ele')(p.ele)
-            for p in passage.waypoints(allowed_waypoint_types):
-                with d.tag('wpt', lat=p.lat, lon=p.lon):
-                    d.tag('ele')(p.ele)
-                    d.tag('name')(p.name)
-                    if p.comment:
-                        d.tag('comment')(p.comment)
-                    d.printr(
-                        '<extensions><coros_type>19</coros_type><coros_flag>0</coros_flag></extensions>'
-                    )
+        if merge:
+            starts = {}
+            for part_name, tracks in track_parts(
+                name, merged_track(passages, reverse, starts), max_points
+            ):
+                with d.tag('trk'):
+                    d.tag('name')(part_name)
+                    with d.tag('trkseg'):
+                        write_tracks(d, tracks, gpx_point)
+            for passage in ordered(passages, reverse):
+                if boundaries and passage.passage in starts:
+                    gpx_waypoint(d, starts[passage.passage])
+                for p in passage.waypoints(waypoint_mask, reverse):
+                    gpx_waypoint(d, p)
+            return
+        for passage in ordered(passages, reverse):
+            for part_name, tracks in track_parts(
+                passage.formatted_name(),
+                [ordered_track(passage, reverse)],
+                max_points,
+            ):
+                with d.tag('trk'):
+                    d.tag('name')(part_name)
+                    with d.tag('trkseg'):
+                        write_tracks(d, tracks, gpx_point)
+            for p in passage.waypoints(waypoint_mask, reverse):
+                gpx_waypoint(d, p)
+
+
+# Waypoints are rendered once and reused across downloads.
+@tags.fragment(maxsize=4096)
+def gpx_waypoint(d, p) -> None:
+    with d.tag('wpt', lat=p.lat, lon=p.lon):
+        d.tag('ele')(p.ele)
+        d.tag('name')(p.name)
+        if p.comment:
+            d.tag('comment')(p.comment)
+        d.printr(
+            '<extensions><coros_type>19</coros_type><coros_flag>0</coros_flag></extensions>'
+        )
 
 
 styles = """
@@ -213,7 +357,16 @@ styles = """
 """
 
 
-def kml(write, name, passages, allowed_waypoint_types, direction) -> None:
+def kml(
+    write,
+    name,
+    passages,
+    waypoint_mask,
+    reverse,
+    max_points=0,
+    merge=False,
+    boundaries=False,
+) -> None:
     d = tags.XDocument(write)
     d.printr('<?xml version="1.0" encoding="UTF-8"?>')
     with d.tag('kml', xmlns='http://www.opengis.net/kml/2.2'):
@@ -221,27 +374,55 @@ def kml(write, name, passages, allowed_waypoint_types, direction) -> None:
             d.tag('name')(name)
             d.tag('open')('1')
             d.printr(styles)
-            for passage in direction(passages):
-                with d.tag('Folder'):
-                    d.tag('name')(passage.formatted_name())
+            if merge:
+                starts = {}
+                for part_name, tracks in track_parts(
+                    name, merged_track(passages, reverse, starts), max_points
+                ):
                     with d.tag('Placemark'):
-                        d.tag('name')(passage.formatted_name())
-                        d.tag('styleUrl')(f'#{passage.style()}')
+                        d.tag('name')(part_name)
+                        d.tag('styleUrl')('#P1')
                         with d.tag('MultiGeometry'):
                             with d.tag('LineString'):
                                 d.tag('tesselate')('1')
                                 with d.tag('coordinates'):
-                                    for p in direction(passage.track()):
-                                        d.printr(f'{p.lon},{p.lat},{p.ele}\n')
+                                    write_tracks(d, tracks, kml_point)
+                with d.tag('Folder'):
+                    d.tag('name')('Waypoints')
+                    for passage in ordered(passages, reverse):
+                        if boundaries and passage.passage in starts:
+                            kml_waypoint(d, starts[passage.passage])
+                        for p in passage.waypoints(waypoint_mask, reverse):
+                            kml_waypoint(d, p)
+                return
+            for passage in ordered(passages, reverse):
+                with d.tag('Folder'):
+                    d.tag('name')(passage.formatted_name())
+                    for part_name, tracks in track_parts(
+                        passage.formatted_name(),
+                        [ordered_track(passage, reverse)],
+                        max_points,
+                    ):
+                        with d.tag('Placemark'):
+                            d.tag('name')(part_name)
+                            d.tag('styleUrl')(f'#{passage.style()}')
+                            with d.tag('MultiGeometry'):
+                                with d.tag('LineString'):
+                                    d.tag('tesselate')('1')
+                                    with d.tag('coordinates'):
+                                        write_tracks(d, tracks, kml_point)
                     with d.tag('Folder'):
                         d.tag('name')('Waypoints')
-                        for p in passage.waypoints(allowed_waypoint_types):
-                            with d.tag('Placemark'):
-                                d.tag('name')(p.name)
-                                if p.comment:
-                                    d.tag('description')(p.comment)
-                                d.tag('styleUrl')(f'#{p.style()}')
-                                with d.tag('Point'):
-                                    d.tag('coordinates')(
-                                        f'{p.lon},{p.lat},{p.ele}'
-                                    )
+                        for p in passage.waypoints(waypoint_mask, reverse):
+                            kml_waypoint(d, p)
+
+
+@tags.fragment(maxsize=4096)
+def kml_waypoint(d, p) -> None:
+    with d.tag('Placemark'):
+        d.tag('name')(p.name)
+        if p.comment:
+            d.tag('description')(p.comment)
+        d.tag('styleUrl')(f'#{p.style()}')
+        with d.tag('Point'):
+            d.tag('coordinates')(f'{p.lon},{p.lat},{p.ele}')
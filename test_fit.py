@@ -0,0 +1,194 @@
+# Round-trip tests for the FIT course files written by fit.py.
+#
+#   python3 -m pytest test_fit.py
+
+import io
+import struct
+import typing
+
+import pytest
+
+import fit
+
+_SEMICIRCLES = 2**31 / 180
+
+
+class Waypoint(typing.NamedTuple):
+    name: str
+    type: str
+    lon: float
+    lat: float
+    mile: float
+
+
+class Passage(typing.NamedTuple):
+    # The attributes of main.Passage used by fit.course.
+    passage: str
+    name: str
+    points: tuple
+    waypoint_list: tuple
+    start_mile: float
+
+    def formatted_name(self) -> str:
+        return f'{self.passage}: {self.name}'
+
+    def coords(self):
+        return list(self.points)
+
+    def waypoints(self, waypoint_mask, reverse=False):
+        _ = waypoint_mask
+        return sorted(
+            self.waypoint_list, key=lambda p: p.mile, reverse=reverse
+        )
+
+
+def _passages() -> list[Passage]:
+    # Two passages north along a meridian that share the junction point.
+    # 0.01 degrees of latitude is about 0.69 miles.
+    first = tuple((-111.0, 31.0 + i * 0.01, 1000.0 + i) for i in range(11))
+    second = tuple((-111.0, 31.1 + i * 0.01, 1010.0 - i) for i in range(11))
+    return [
+        Passage(
+            '01',
+            'One',
+            first,
+            (
+                Waypoint('Spring', 'Water', -111.0, 31.02, 1.4),
+                Waypoint('Camp', 'Campground', -111.0, 31.07, 4.8),
+            ),
+            0.0,
+        ),
+        Passage(
+            '02',
+            'Two',
+            second,
+            (Waypoint('Bridge', 'Bridge', -111.0, 31.15, 10.4),),
+            6.9,
+        ),
+    ]
+
+
+class Message(typing.NamedTuple):
+    number: int
+    fields: dict[int, typing.Any]
+
+
+def decode(b: bytes) -> list[Message]:
+    # Decode a FIT file, checking the header and file CRCs.
+    header_size, protocol, _, data_size, tag = struct.unpack_from('<BBHI4s', b)
+    assert header_size == 14
+    assert protocol == 0x10
+    assert tag == b'.FIT'
+    (header_crc,) = struct.unpack_from('<H', b, 12)
+    assert header_crc == fit.crc(b[:12])
+    assert len(b) == header_size + data_size + 2
+    (file_crc,) = struct.unpack_from('<H', b, header_size + data_size)
+    assert file_crc == fit.crc(b[: header_size + data_size])
+
+    codes = {1: 'B', 2: 'H', 4: 'I'}
+    signed = {0x85}
+    definitions = {}
+    messages = []
+    f = io.BytesIO(b[header_size : header_size + data_size])
+    while f.tell() < data_size:
+        (h,) = f.read(1)
+        assert not h & 0x80, 'compressed timestamp headers are not used'
+        local = h & 0x0F
+        if h & 0x40:
+            _, arch, number, n = struct.unpack('<BBHB', f.read(5))
+            assert arch == 0
+            fields = [struct.unpack('<BBB', f.read(3)) for _ in range(n)]
+            definitions[local] = (number, fields)
+            continue
+        assert local in definitions, f'data for undefined local type {local}'
+        number, fields = definitions[local]
+        values = {}
+        for num, size, base in fields:
+            raw = f.read(size)
+            if base == 0x07:
+                values[num] = raw.split(b'\0', 1)[0].decode('utf-8')
+            else:
+                code = codes[size]
+                if base in signed:
+                    code = code.lower()
+                (values[num],) = struct.unpack('<' + code, raw)
+        messages.append(Message(number, values))
+    return messages
+
+
+def render(**kwargs) -> bytes:
+    out = io.BytesIO()
+    args = dict(
+        name='AZT Test',
+        passages=_passages(),
+        waypoint_mask=~0,
+        reverse=False,
+    )
+    args.update(kwargs)
+    fit.course(out.write, **args)
+    return out.getvalue()
+
+
+def of_type(messages: list[Message], number: int) -> list[Message]:
+    return [m for m in messages if m.number == number]
+
+
+def test_crc_and_messages():
+    messages = decode(render())
+    assert [m.number for m in messages[:4]] == [
+        fit._FILE_ID,
+        fit._COURSE,
+        fit._LAP,
+        fit._EVENT,
+    ]
+    assert messages[-1].number == fit._EVENT
+    (file_id,) = of_type(messages, fit._FILE_ID)
+    assert file_id.fields[0] == 6  # course file
+    (course,) = of_type(messages, fit._COURSE)
+    assert course.fields[5] == 'AZT Test'
+
+
+@pytest.mark.parametrize('reverse', [False, True])
+def test_records(reverse):
+    passages = _passages()
+    points = [p for passage in passages for p in passage.points]
+    # The junction point is written once.
+    del points[len(passages[0].points)]
+    if reverse:
+        points.reverse()
+
+    messages = decode(render(reverse=reverse))
+    records = of_type(messages, fit._RECORD)
+    assert len(records) == len(points)
+    for record, point in ((records[0], points[0]), (records[-1], points[-1])):
+        assert record.fields[0] == round(point[1] * _SEMICIRCLES)
+        assert record.fields[1] == round(point[0] * _SEMICIRCLES)
+    distances = [r.fields[5] for r in records]
+    assert distances[0] == 0
+    assert all(a < b for a, b in zip(distances, distances[1:]))
+
+    (lap,) = of_type(messages, fit._LAP)
+    assert lap.fields[9] == distances[-1]
+
+
+@pytest.mark.parametrize('reverse', [False, True])
+def test_course_points(reverse):
+    messages = decode(render(reverse=reverse, boundaries=True))
+    course_points = of_type(messages, fit._COURSE_POINT)
+    names = [m.fields[6] for m in course_points]
+    if reverse:
+        assert names == ['Bridge', 'Passage 01: One', 'Camp', 'Spring']
+    else:
+        assert names == ['Spring', 'Camp', 'Passage 02: Two', 'Bridge']
+    assert [m.fields[254] for m in course_points] == list(range(4))
+    distances = [m.fields[4] for m in course_points]
+    assert distances == sorted(distances)
+    total = of_type(messages, fit._RECORD)[-1].fields[5]
+    assert 0 < distances[0] and distances[-1] < total
+
+
+def test_max_points():
+    records = of_type(decode(render(max_points=5)), fit._RECORD)
+    assert 2 <= len(records) <= 5
+    distances = [r.fields[5] for r in records]
+    assert all(a < b for a, b in zip(distances, distances[1:]))
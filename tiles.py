@@ -0,0 +1,133 @@
+# Track geometry for slippy map tiles.
+#
+# build.py stores a Douglas-Peucker simplification of each passage track per
+# zoom level (0 through MAX_ZOOM) in the simplified table. The server clips
+# the level for the requested zoom to the tile. Above MAX_ZOOM, the full
+# resolution track is used.
+
+from collections import abc
+import math
+import typing
+
+MAX_ZOOM = 12
+
+# Waypoints are only included in tiles at this zoom and above.
+WAYPOINT_MIN_ZOOM = 10
+
+# Tile size in pixels.
+_TILE_SIZE = 256
+
+
+def tolerance(zoom: int) -> float:
+    # Simplification tolerance in degrees: half a pixel at zoom.
+    return 360 / (_TILE_SIZE * 2**zoom) / 2
+
+
+def digits(zoom: int) -> int:
+    # Decimal digits needed to locate a coordinate to a pixel at zoom.
+    return max(0, math.ceil(math.log10(_TILE_SIZE * 2**zoom / 360)) + 1)
+
+
+def simplify(
+    points: abc.Sequence[tuple[float, ...]], tol: float
+) -> list[tuple[float, ...]]:
+    # Simplify a line with the Douglas-Peucker algorithm. The first two values
+    # of each point are the coordinates. Other values are carried along.
+    n = len(points)
+    if n < 3:
+        return list(points)
+    keep = [False] * n
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    tol2 = tol * tol
+    while stack:
+        first, last = stack.pop()
+        x1, y1 = points[first][:2]
+        x2, y2 = points[last][:2]
+        dx = x2 - x1
+        dy = y2 - y1
+        dd = dx * dx + dy * dy
+        max_d2 = -1.0
+        index = first
+        for i in range(first + 1, last):
+            x, y = points[i][:2]
+            if dd == 0:
+                d2 = (x - x1) ** 2 + (y - y1) ** 2
+            else:
+                t = ((x - x1) * dx + (y - y1) * dy) / dd
+                t = min(1.0, max(0.0, t))
+                d2 = (x - x1 - t * dx) ** 2 + (y - y1 - t * dy) ** 2
+            if d2 > max_d2:
+                max_d2 = d2
+                index = i
+        if max_d2 > tol2:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return [p for p, k in zip(points, keep) if k]
+
+
+class BBox(typing.NamedTuple):
+    west: float
+    south: float
+    east: float
+    north: float
+
+    def expand(self, d: float) -> 'BBox':
+        return BBox(
+            self.west - d, self.south - d, self.east + d, self.north + d
+        )
+
+    def intersects(self, other: 'BBox') -> bool:
+        return (
+            self.west <= other.east
+            and other.west <= self.east
+            and self.south <= other.north
+            and other.south <= self.north
+        )
+
+    def contains(self, lon: float, lat: float) -> bool:
+        return (
+            self.west <= lon <= self.east and self.south <= lat <= self.north
+        )
+
+
+def line_bbox(points: abc.Iterable[tuple[float, float]]) -> BBox:
+    lons, lats = zip(*points)
+    return BBox(min(lons), min(lats), max(lons), max(lats))
+
+
+def tile_bbox(z: int, x: int, y: int) -> BBox:
+    # Bounds of a web mercator tile in degrees.
+    n = 2**z
+
+    def lat(y: int) -> float:
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+
+    return BBox(x / n * 360 - 180, lat(y + 1), (x + 1) / n * 360 - 180, lat(y))
+
+
+def clip(
+    points: abc.Sequence[tuple[float, float]], bbox: BBox
+) -> list[list[tuple[float, float]]]:
+    # Return the runs of points with segments that intersect bbox. Segments
+    # crossing the tile edge are kept whole so that lines join up across
+    # adjacent tiles.
+    parts: list[list[tuple[float, float]]] = []
+    part: list[tuple[float, float]] = []
+    for i in range(1, len(points)):
+        a = points[i - 1]
+        b = points[i]
+        seg = BBox(
+            min(a[0], b[0]), min(a[1], b[1]), max(a[0], b[0]), max(a[1], b[1])
+        )
+        if seg.intersects(bbox):
+            if not part:
+                part.append(a)
+            part.append(b)
+        elif part:
+            parts.append(part)
+            part = []
+    if part:
+        parts.append(part)
+    return parts
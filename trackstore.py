@@ -0,0 +1,139 @@
+# Tracks as packed arrays in a memory mapped file.
+#
+# build.py writes the tracks of all passages to tracks.bin as little endian
+# float64 (lon, lat, ele) triples, and the offset and number of points of
+# each track to the passages table. The server maps the file read-only, so
+# the server process and all render worker processes share one copy of the
+# tracks in the page cache instead of each holding parsed tracks in memory.
+#
+# A Track holds the lon, lat and ele of its points in separate lists and
+# formats runs of points with a single join, instead of creating and
+# formatting an object per point. Converting the floats to text is most of
+# the cost of writing a track, so a Store converts each track once and keeps
+# the text.
+
+from collections import abc
+import array
+import mmap
+import pathlib
+import sqlite3
+import struct
+import sys
+
+FILE = 'tracks.bin'
+
+point = struct.Struct('<3d')
+
+
+# Number of points formatted per write.
+_CHUNK = 4096
+
+
+class Track:
+    # Points of a track as lon, lat and ele lists. The numbers are strings in
+    # the format of the track CSV files.
+
+    __slots__ = ('lon', 'lat', 'ele')
+
+    def __init__(self, lon: list[str], lat: list[str], ele: list[str]):
+        self.lon = lon
+        self.lat = lat
+        self.ele = ele
+
+    @classmethod
+    def from_rows(cls, rows: abc.Iterable[abc.Sequence[str]]) -> 'Track':
+        # Return the track for (lon, lat, ele) rows of strings.
+        lon = []
+        lat = []
+        ele = []
+        for row in rows:
+            lon.append(row[0])
+            lat.append(row[1])
+            ele.append(row[2])
+        return cls(lon, lat, ele)
+
+    def __len__(self) -> int:
+        return len(self.lon)
+
+    def __getitem__(self, s: slice) -> 'Track':
+        return Track(self.lon[s], self.lat[s], self.ele[s])
+
+    def reversed(self) -> 'Track':
+        return self[::-1]
+
+    def point(self, i: int) -> tuple[str, str, str]:
+        return self.lon[i], self.lat[i], self.ele[i]
+
+    def write(self, write: abc.Callable[[str], object], fmt: str) -> None:
+        # Write each point formatted with fmt.format(lon, lat, ele).
+        for i in range(0, len(self), _CHUNK):
+            s = slice(i, i + _CHUNK)
+            write(
+                ''.join(map(fmt.format, self.lon[s], self.lat[s], self.ele[s]))
+            )
+
+
+class Store:
+    # Tracks of a data version.
+
+    def __init__(self, path: pathlib.Path, index: dict[str, tuple[int, int]]):
+        # index maps track file name to offset and number of points.
+        self._index = index
+        # Tracks by file name, converted to text on first use. Threads that
+        # convert a track at the same time store equal tracks.
+        self._tracks: dict[str, Track] = {}
+        with path.open('rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __contains__(self, fname: str) -> bool:
+        return fname in self._index
+
+    def points(self, fname: str) -> int:
+        # Return the number of points in the track.
+        return self._index[fname][1]
+
+    def track(self, fname: str) -> Track:
+        # Return the track with separate lon, lat and ele lists. The numbers
+        # are formatted with str, the same as the CSV files.
+        t = self._tracks.get(fname)
+        if t is None:
+            offset, n = self._index[fname]
+            start = offset * point.size
+            points = array.array('d')
+            points.frombytes(self._mmap[start : start + n * point.size])
+            if sys.byteorder != 'little':
+                points.byteswap()
+            t = Track(
+                list(map(str, points[0::3])),
+                list(map(str, points[1::3])),
+                list(map(str, points[2::3])),
+            )
+            self._tracks[fname] = t
+        return t
+
+    def coords(self, fname: str) -> list[tuple[float, float, float]]:
+        # Return the (lon, lat, ele) points of the track.
+        offset, n = self._index[fname]
+        start = offset * point.size
+        # Slicing the map copies the bytes, so no view of the map outlives
+        # the call.
+        return list(
+            point.iter_unpack(self._mmap[start : start + n * point.size])
+        )
+
+
+def open_store(path: pathlib.Path, con: sqlite3.Connection) -> Store | None:
+    # Open the store in the data directory path. Return None if the data was
+    # built without a store.
+    if not (path / FILE).exists():
+        return None
+    index = {
+        fname: (offset, n)
+        for fname, offset, n in con.execute(
+            """SELECT fname, track_offset, track_points FROM passages
+               WHERE track_points > 0"""
+        )
+    }
+    if not index:
+        return None
+    return Store(path / FILE, index)
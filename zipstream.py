@@ -0,0 +1,90 @@
+# Streaming ZIP archive writer.
+#
+# Files are added with data that is already compressed with raw deflate, so
+# that compressed files can be cached and copied to any number of archives.
+# Because the sizes and CRC are known up front, no data descriptors are
+# needed and the archive is written strictly in order.
+
+import struct
+import time
+import zlib
+
+_DEFLATED = 8
+_VERSION = 20
+# Bit 11: file names are UTF-8.
+_FLAGS = 0x800
+
+
+class File:
+    __slots__ = ('data', 'crc', 'size')
+
+    def __init__(self, data: bytes, crc: int, size: int):
+        # Raw deflate data, CRC-32 and size of the uncompressed data.
+        self.data = data
+        self.crc = crc
+        self.size = size
+
+
+def compress(b: bytes) -> File:
+    c = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+    return File(c.compress(b) + c.flush(), zlib.crc32(b), len(b))
+
+
+def _dos_time(t: float) -> tuple[int, int]:
+    tm = time.gmtime(t)
+    year = max(tm.tm_year, 1980)
+    return (
+        (tm.tm_hour << 11) | (tm.tm_min << 5) | (tm.tm_sec // 2),
+        ((year - 1980) << 9) | (tm.tm_mon << 5) | tm.tm_mday,
+    )
+
+
+class Writer:
+    def __init__(self):
+        self._central: list[bytes] = []
+        self._offset = 0
+
+    def file(self, name: str, f: File, mtime: float) -> bytes:
+        # Return the bytes for the file in the archive.
+        fname = name.encode('utf-8')
+        dtime, ddate = _dos_time(mtime)
+        common = struct.pack(
+            '<HHHHHIIIH',
+            _VERSION,
+            _FLAGS,
+            _DEFLATED,
+            dtime,
+            ddate,
+            f.crc,
+            len(f.data),
+            f.size,
+            len(fname),
+        )
+        local = b'PK\x03\x04' + common + b'\x00\x00' + fname
+        self._central.append(
+            b'PK\x01\x02'
+            + struct.pack('<H', _VERSION)
+            + common
+            + struct.pack('<HHHHII', 0, 0, 0, 0, 0, self._offset)
+            + fname
+        )
+        self._offset += len(local) + len(f.data)
+        return local + f.data
+
+    def close(self) -> bytes:
+        # Return the central directory at the end of the archive.
+        central = b''.join(self._central)
+        return (
+            central
+            + b'PK\x05\x06'
+            + struct.pack(
+                '<HHHHIIH',
+                0,
+                0,
+                len(self._central),
+                len(self._central),
+                len(central),
+                self._offset,
+                0,
+            )
+        )